@@ -0,0 +1,62 @@
+"""Benchmark the IRC line framer and parser.
+
+Feeds a synthetic stream of coalesced IRC lines through LineFramer in
+random-sized chunks and reports parsed lines/sec and dropped lines.
+
+Run from anywhere: python bench/bench_framing.py [line_count]
+"""
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+
+import grokbot
+
+TEMPLATES = [
+    ":nick{n}!user@host.example PRIVMSG #chan{c} :hello there number {n}, how is it going?",
+    "@time=2024-01-01T00:00:{s:02d}.000Z;msgid=abc{n} :nick{n}!u@h PRIVMSG #chan{c} :tagged line {n}",
+    "PING :irc.example.net",
+    ":nick{n}!user@host.example JOIN #chan{c}",
+    ":irc.example.net 353 IRCBot = #chan{c} :nick1 nick2 nick3 @op +voice",
+    ":nick{n}!user@host.example PRIVMSG #chan{c} :été ☃ unicode {n}",
+]
+
+def build_stream(count):
+    lines = []
+    for n in range(count):
+        template = TEMPLATES[n % len(TEMPLATES)]
+        lines.append(template.format(n=n, c=n % 7, s=n % 60))
+    return ("\r\n".join(lines) + "\r\n").encode("UTF-8")
+
+def chunk(data, rng):
+    pos = 0
+    while pos < len(data):
+        size = rng.randint(1, 4096)
+        yield data[pos:pos + size]
+        pos += size
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    data = build_stream(count)
+    chunks = list(chunk(data, random.Random(42)))
+
+    framer = grokbot.LineFramer()
+    parsed = 0
+    start = time.perf_counter()
+    for piece in chunks:
+        parsed += len(framer.feed(piece))
+    elapsed = time.perf_counter() - start
+
+    print(f"lines:     {count}")
+    print(f"chunks:    {len(chunks)}")
+    print(f"parsed:    {parsed}")
+    print(f"dropped:   {count - parsed}")
+    print(f"elapsed:   {elapsed:.3f}s")
+    print(f"lines/sec: {parsed / elapsed:,.0f}")
+
+if __name__ == "__main__":
+    main()
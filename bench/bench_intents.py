@@ -0,0 +1,60 @@
+"""Benchmark intent detection against the number of configured keywords.
+
+Times IntentMatcher.match() and the old per-keyword substring scan on a
+set of typical channel messages, for growing synthetic keyword lists.
+
+Run from anywhere: python bench/bench_intents.py
+"""
+import os
+import random
+import string
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+
+import grokbot
+
+MESSAGES = [
+    "hey bot what's the weather in Toronto tomorrow?",
+    "anyone watching the leafs game tonight",
+    "lol yeah that's what I said yesterday",
+    "IRCBot: summarize what we talked about",
+    "what did caspy say about the new server",
+    "latest news on the election please",
+    "brb coffee",
+    "this is a much longer message that goes on for a while about nothing in particular, "
+    "just to see how the matcher copes with a few hundred characters of ordinary chat text",
+]
+
+def random_keywords(count, rng):
+    words = set()
+    while len(words) < count:
+        words.add("".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 10))))
+    return sorted(words)
+
+def per_message_us(fn, repeat=2000):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for message in MESSAGES:
+            fn(message)
+    return (time.perf_counter() - start) / (repeat * len(MESSAGES)) * 1e6
+
+def main():
+    rng = random.Random(7)
+    print(f"{'keywords':>9} {'matcher us/msg':>15} {'substring scan us/msg':>22}")
+    for count in (10, 100, 1000, 10000):
+        extra = random_keywords(count, rng)
+        matcher = grokbot.IntentMatcher({"trigger": grokbot.keywords + extra, **grokbot.INTENT_PATTERNS})
+        phrases = grokbot.keywords + extra + [p for ps in grokbot.INTENT_PATTERNS.values() for p in ps]
+
+        def scan(message):
+            lower = message.lower()
+            return [p for p in phrases if p in lower]
+
+        print(f"{count:>9} {per_message_us(matcher.match):>15.2f} {per_message_us(scan, repeat=200):>22.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Benchmark channel log indexing and lookups.
+
+Fills a ChannelLogStore with synthetic chat across several channels and
+times !search queries and the per-user / keyword lookups used when
+building prompts.
+
+Run from anywhere: python bench/bench_search.py [line_count]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+
+import grokbot
+
+WORDS = (
+    "the a to and of hockey game leafs habs snow cold coffee beer linux python irc server "
+    "weather rain news election price stock market cat dog pizza maple syrup moose canada "
+    "toronto montreal vancouver friday tonight tomorrow lol yeah nope maybe really great"
+).split()
+
+QUERIES = [
+    "hockey",
+    "maple syrup",
+    '"leafs game"',
+    "from:nick42",
+    "weather in:#chan3",
+    "moose canada tonight",
+    "nonexistentword",
+]
+
+def fill(store, count, rng):
+    start = time.perf_counter()
+    for n in range(count):
+        message = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 15)))
+        store.add(f"#chan{n % 8}", f"nick{rng.randint(0, 500)}", message)
+    return time.perf_counter() - start
+
+def timed(fn, repeat=200):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    path = os.path.join(tempfile.mkdtemp(), "channel_logs.jsonl")
+    store = grokbot.ChannelLogStore(path, retention_hours=72, max_entries=count, flush_interval=5)
+    elapsed = fill(store, count, random.Random(1))
+    print(f"indexed {count} lines in {elapsed:.2f}s ({count / elapsed:,.0f} lines/sec)")
+
+    for query in QUERIES:
+        ms = timed(lambda: store.search(query))
+        print(f"search {query!r:28} {ms:8.3f} ms  ({len(store.search(query))} results)")
+    print(f"recent(50)                     {timed(lambda: store.recent(50)):8.3f} ms")
+    print(f"by_user(nick7, 10)             {timed(lambda: store.by_user('nick7', 10)):8.3f} ms")
+    print(f"relevant(nick7, 5)             {timed(lambda: store.relevant('nick7', 5)):8.3f} ms")
+    print(f"find_user('what did nick9 say') {timed(lambda: store.find_user('what did nick9 say', exclude='nick7')):7.3f} ms")
+
+if __name__ == "__main__":
+    main()
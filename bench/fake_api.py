@@ -0,0 +1,145 @@
+"""Mock xAI and open-meteo HTTP server for load tests.
+
+Serves /v1/chat/completions and /v1/responses (plain JSON or server-sent
+events), plus the open-meteo /v1/search and /v1/forecast endpoints, with
+configurable latency and error injection. Answers echo the first
+q<digits> token found in the question so the load test can match
+replies to questions.
+
+Run standalone: python bench/fake_api.py --port 18080 --latency 0.5
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+
+TOKEN_RE = re.compile(r"\bq\d+\b")
+
+class FakeAPI:
+    def __init__(self, latency=0.2, chunk_delay=0.02, error_rate=0.0, lines=3, seed=None):
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.error_rate = error_rate
+        self.lines = lines
+        self.rng = random.Random(seed)
+        self.requests = {}
+        self.errors = 0
+        self.server = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode().partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                await self.respond(writer, method, target, json.loads(body) if body else {})
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, method, target, payload):
+        path = target.split("?", 1)[0]
+        self.requests[path] = self.requests.get(path, 0) + 1
+        await asyncio.sleep(self.latency)
+
+        if path.endswith(("/chat/completions", "/responses")) and self.rng.random() < self.error_rate:
+            self.errors += 1
+            await self.send_json(writer, {"error": "injected failure"}, status="503 Service Unavailable")
+            return
+
+        if path.endswith("/search"):
+            await self.send_json(writer, {"results": [
+                {"latitude": 43.65, "longitude": -79.38, "name": "Toronto", "country": "Canada"}
+            ]})
+        elif path.endswith("/forecast"):
+            await self.send_json(writer, {
+                "current": {"temperature_2m": 41.0, "relative_humidity_2m": 70, "wind_speed_10m": 9.5},
+                "daily": {"time": ["d1", "d2", "d3"], "temperature_2m_max": [45, 47, 50],
+                          "temperature_2m_min": [33, 35, 38], "precipitation_probability_max": [10, 40, 80]}
+            })
+        elif path.endswith("/chat/completions"):
+            answer = self.answer(payload.get("messages", []))
+            if payload.get("stream"):
+                await self.send_stream(writer, [{"choices": [{"delta": {"content": piece}}]} for piece in self.pieces(answer)])
+            else:
+                await self.send_json(writer, {"choices": [{"message": {"role": "assistant", "content": answer}}]})
+        elif path.endswith("/responses"):
+            answer = self.answer(payload.get("input", []))
+            output = [
+                {"type": "message", "content": [{"type": "output_text", "text": answer}]},
+                {"type": "search_result", "url": "https://example.com/story"}
+            ]
+            if payload.get("stream"):
+                events = [{"type": "response.output_text.delta", "delta": piece} for piece in self.pieces(answer)]
+                events.append({"type": "response.completed", "response": {"output": output}})
+                await self.send_stream(writer, events)
+            else:
+                await self.send_json(writer, {"output": output})
+        else:
+            await self.send_json(writer, {"error": "not found"}, status="404 Not Found")
+
+    def answer(self, messages):
+        question = messages[-1].get("content", "") if messages else ""
+        match = TOKEN_RE.search(question)
+        token = match.group(0) if match else "q?"
+        return "\n".join(f"{token} answer line {i + 1} with some filler text" for i in range(self.lines))
+
+    def pieces(self, text, size=12):
+        return [text[i:i + size] for i in range(0, len(text), size)]
+
+    async def send_json(self, writer, data, status="200 OK"):
+        body = json.dumps(data).encode()
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+
+    async def send_stream(self, writer, events):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+        for event in events + ["[DONE]"]:
+            data = event if isinstance(event, str) else json.dumps(event)
+            chunk = f"data: {data}\n\n".encode()
+            writer.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+            await writer.drain()
+            await asyncio.sleep(self.chunk_delay)
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+async def serve(args):
+    api = FakeAPI(args.latency, args.chunk_delay, args.error_rate, args.lines)
+    port = await api.start(args.host, args.port)
+    print(f"Fake API listening on http://{args.host}:{port}/v1")
+    await asyncio.Event().wait()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds before the first byte")
+    parser.add_argument("--chunk-delay", type=float, default=0.02, help="seconds between streamed chunks")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of API calls answered with 503")
+    parser.add_argument("--lines", type=int, default=3, help="lines per answer")
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
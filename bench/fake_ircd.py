@@ -0,0 +1,80 @@
+"""Minimal stand-in ircd for load tests.
+
+Accepts one client at a time, completes registration (001), echoes JOINs,
+answers PINGs and records every line the client sends. The load test
+pushes channel traffic with send().
+"""
+import asyncio
+import time
+
+class FakeIRCd:
+    def __init__(self, name="fake.ircd"):
+        self.name = name
+        self.writer = None
+        self.nick = None
+        self.joined = set()
+        self.received = []
+        self.registered = asyncio.Event()
+        self.listeners = []
+        self.server = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.writer:
+            self.writer.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def wait_joined(self, channels, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not set(c.lower() for c in channels) <= self.joined:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"bot joined {sorted(self.joined)}, expected {sorted(channels)}")
+            await asyncio.sleep(0.05)
+
+    def send(self, line):
+        if self.writer is not None:
+            self.writer.write(f"{line}\r\n".encode("UTF-8"))
+
+    async def drain(self):
+        if self.writer is not None:
+            await self.writer.drain()
+
+    async def handle(self, reader, writer):
+        self.writer = writer
+        try:
+            while True:
+                raw = await reader.readline()
+                if not raw:
+                    break
+                line = raw.decode("UTF-8", errors="replace").rstrip("\r\n")
+                now = time.monotonic()
+                self.received.append((now, line))
+                command, _, rest = line.partition(" ")
+                command = command.upper()
+                if command == "NICK":
+                    self.nick = rest.strip().lstrip(":")
+                elif command == "USER":
+                    self.send(f":{self.name} 001 {self.nick} :Welcome to the fake network {self.nick}")
+                    self.registered.set()
+                elif command == "JOIN":
+                    for channel in rest.split()[0].split(","):
+                        self.joined.add(channel.lower())
+                        self.send(f":{self.nick}!bot@fake.host JOIN {channel}")
+                elif command == "PING":
+                    self.send(f":{self.name} PONG {self.name} {rest}")
+                elif command == "CAP":
+                    if rest.startswith("LS"):
+                        self.send(f":{self.name} CAP * LS :")
+                for listener in self.listeners:
+                    listener(now, command, rest)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            if self.writer is writer:
+                self.writer = None
+            writer.close()
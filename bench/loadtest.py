@@ -0,0 +1,270 @@
+"""End-to-end load test against a fake ircd and a mock xAI/open-meteo API.
+
+Starts bench/fake_ircd.py and bench/fake_api.py in-process, launches
+grokbot.py as a subprocess in a scratch directory with a generated
+grok.conf pointing at them, then replays channel traffic at a fixed rate:
+background chatter from many users plus keyword-triggered questions
+tagged with a q<N> token. Reports messages handled per second,
+time-to-first-reply percentiles, RSS growth of the bot process, dropped
+inbound lines, error replies and unanswered questions.
+
+Traffic can be synthetic (default) or replayed from a file of
+"<channel> <nick> <message>" lines (--replay).
+
+Run from anywhere: python bench/loadtest.py --channels 8 --users 50 --rate 40 --duration 30
+"""
+import argparse
+import asyncio
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+from fake_api import FakeAPI
+from fake_ircd import FakeIRCd
+
+WORDS = (
+    "the a to and of hockey game leafs habs snow cold coffee beer linux python irc server "
+    "weather rain news election price stock market cat dog pizza maple syrup moose canada "
+    "toronto montreal vancouver friday tonight tomorrow lol yeah nope maybe really great"
+).split()
+
+QUESTIONS = [
+    "bot {token} what do you think about {word}?",
+    "bot {token} explain {word} in one line",
+    "bot {token} any news on {word} today",
+    "bot {token} weather in toronto",
+]
+
+TOKEN_RE = re.compile(r"\bq\d+\b")
+BOT_NICK = "LoadBot"
+# Only the channel lines the load test sends, not PINGs, JOINs or numerics
+RECEIVED_SERIES = 'grokbot_messages_received_total{command="PRIVMSG"}'
+
+def write_config(directory, irc_port, api_port, metrics_port, channels, stream):
+    with open(os.path.join(ROOT, "grok.conf"), "r") as f:
+        conf = f.read()
+    api_base = f"http://127.0.0.1:{api_port}/v1"
+    replacements = {
+        "api_key": "loadtest",
+        "api_base": api_base,
+        "stream": "true" if stream else "false",
+        "server": "127.0.0.1",
+        "port": str(irc_port),
+        "ssl": "false",
+        "channels": ",".join(channels),
+        "nickname": BOT_NICK,
+        "keywords": "bot",
+        "flood_burst": "1000",
+        "flood_rate": "1000",
+        "send_queue_size": "10000",
+        "geocoding_url": f"{api_base}/search",
+        "forecast_url": f"{api_base}/forecast",
+        "console": "false",
+        "authorized_users": "nobody",
+    }
+    section = None
+    lines = []
+    for line in conf.splitlines():
+        if line.startswith("["):
+            section = line.strip("[]")
+        key = line.split("=", 1)[0].strip()
+        if "=" in line and key in replacements:
+            value = replacements[key]
+            if key == "port" and section == "metrics":
+                value = str(metrics_port)
+            line = f"{key} = {value}"
+        lines.append(line)
+    with open(os.path.join(directory, "grok.conf"), "w") as f:
+        f.write("\n".join(lines) + "\n")
+    if os.path.exists(os.path.join(ROOT, "context.txt")):
+        shutil.copy(os.path.join(ROOT, "context.txt"), directory)
+
+def free_port():
+    import socket
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def rss_kb(pid):
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+def scrape_metric(metrics_port, series):
+    # series is a metric name plus its labels exactly as rendered, e.g. name{label="value"}
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics", timeout=2) as response:
+            text = response.read().decode()
+    except OSError:
+        return None
+    total = 0.0
+    for line in text.splitlines():
+        if line.rsplit(" ", 1)[0] == series:
+            total += float(line.rsplit(" ", 1)[1])
+    return total
+
+def synthetic_traffic(channels, users, question_ratio, rng):
+    askers = [f"asker{i}" for i in range(max(1, users // 5))]
+    chatters = [f"user{i}" for i in range(users)]
+    counter = 0
+    while True:
+        channel = rng.choice(channels)
+        if rng.random() < question_ratio:
+            counter += 1
+            template = rng.choice(QUESTIONS)
+            yield channel, rng.choice(askers), template.format(token=f"q{counter}", word=rng.choice(WORDS))
+        else:
+            yield channel, rng.choice(chatters), " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 12)))
+
+def replay_traffic(path):
+    while True:
+        with open(path, "r") as f:
+            for line in f:
+                parts = line.rstrip("\n").split(" ", 2)
+                if len(parts) == 3:
+                    yield parts[0], parts[1], parts[2]
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+async def run(args):
+    rng = random.Random(args.seed)
+    channels = [f"#load{i}" for i in range(args.channels)]
+
+    ircd = FakeIRCd()
+    api = FakeAPI(args.latency, args.chunk_delay, args.error_rate, args.lines, seed=args.seed)
+    irc_port = await ircd.start()
+    api_port = await api.start()
+    metrics_port = free_port()
+
+    asked = {}
+    first_reply = {}
+    # Failed answers ("Sorry, ...") carry no q-token, so they are counted, not matched
+    error_replies = 0
+
+    def on_line(now, command, rest):
+        nonlocal error_replies
+        if command != "PRIVMSG":
+            return
+        match = TOKEN_RE.search(rest)
+        if match and match.group(0) in asked and match.group(0) not in first_reply:
+            first_reply[match.group(0)] = now - asked[match.group(0)]
+        elif not match and rest.partition(" :")[2].startswith("Sorry"):
+            error_replies += 1
+
+    ircd.listeners.append(on_line)
+
+    workdir = tempfile.mkdtemp(prefix="grokbot-load-")
+    write_config(workdir, irc_port, api_port, metrics_port, channels, not args.no_stream)
+    bot = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "grokbot.py")],
+        cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        await asyncio.wait_for(ircd.registered.wait(), timeout=15)
+        await ircd.wait_joined(channels)
+        await asyncio.sleep(0.5)
+
+        received_before = scrape_metric(metrics_port, RECEIVED_SERIES) or 0
+        rss_start = rss_kb(bot.pid)
+        rss_peak = rss_start
+        traffic = replay_traffic(args.replay) if args.replay else synthetic_traffic(channels, args.users, args.question_ratio, rng)
+
+        sent = 0
+        interval = 1.0 / args.rate
+        start = time.monotonic()
+        next_send = start
+        while time.monotonic() - start < args.duration:
+            channel, nick, message = next(traffic)
+            ircd.send(f":{nick}!{nick}@load.test PRIVMSG {channel} :{message}")
+            match = TOKEN_RE.search(message)
+            if match and message.startswith("bot"):
+                asked[match.group(0)] = time.monotonic()
+            sent += 1
+            if sent % 100 == 0:
+                await ircd.drain()
+                rss_peak = max(rss_peak, rss_kb(bot.pid))
+            next_send += interval
+            delay = next_send - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await ircd.drain()
+        send_elapsed = time.monotonic() - start
+
+        # Give in-flight answers time to land.
+        grace_end = time.monotonic() + args.grace
+        while time.monotonic() < grace_end and len(first_reply) + error_replies < len(asked):
+            await asyncio.sleep(0.1)
+            rss_peak = max(rss_peak, rss_kb(bot.pid))
+
+        received_after = scrape_metric(metrics_port, RECEIVED_SERIES)
+        rss_end = rss_kb(bot.pid)
+    finally:
+        bot.terminate()
+        try:
+            bot.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        # Let the server-side handlers see the disconnect before shutting down.
+        await asyncio.sleep(0.2)
+        await ircd.stop()
+        await api.stop()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    handled = None if received_after is None else int(received_after - received_before)
+    latencies = list(first_reply.values())
+    print(f"Channels: {args.channels}  users: {args.users}  target rate: {args.rate}/s  duration: {args.duration}s")
+    print(f"API latency: {args.latency}s  error rate: {args.error_rate:.0%}  streaming: {not args.no_stream}")
+    print(f"Sent {sent} lines in {send_elapsed:.1f}s ({sent / send_elapsed:.1f}/s)")
+    if handled is None:
+        print("Handled: metrics endpoint unreachable")
+    else:
+        print(f"Handled {handled} lines ({handled / send_elapsed:.1f}/s), dropped {max(0, sent - handled)}")
+    unanswered = max(0, len(asked) - len(first_reply) - error_replies)
+    print(f"Questions: {len(asked)} asked, {len(first_reply)} answered, {error_replies} error replies, {unanswered} unanswered")
+    print(
+        f"Time to first reply: p50 {percentile(latencies, 0.5) * 1000:.0f}ms  "
+        f"p90 {percentile(latencies, 0.9) * 1000:.0f}ms  p99 {percentile(latencies, 0.99) * 1000:.0f}ms  "
+        f"max {max(latencies, default=float('nan')) * 1000:.0f}ms"
+    )
+    print(f"RSS: start {rss_start / 1024:.1f}MB  peak {rss_peak / 1024:.1f}MB  end {rss_end / 1024:.1f}MB  growth {(rss_end - rss_start) / 1024:+.1f}MB")
+    print(f"API requests: {dict(sorted(api.requests.items()))}  injected errors: {api.errors}")
+    if args.keep:
+        print(f"Bot working directory kept at {workdir}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--channels", type=int, default=4)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--rate", type=float, default=20, help="inbound lines per second")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of traffic")
+    parser.add_argument("--question-ratio", type=float, default=0.1, help="fraction of lines that are questions")
+    parser.add_argument("--latency", type=float, default=0.3, help="mock API seconds before the first byte")
+    parser.add_argument("--chunk-delay", type=float, default=0.02, help="mock API seconds between streamed chunks")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of API calls answered with 503")
+    parser.add_argument("--lines", type=int, default=3, help="lines per mock answer")
+    parser.add_argument("--no-stream", action="store_true", help="disable streaming in the bot config")
+    parser.add_argument("--replay", help="file of '<channel> <nick> <message>' lines to replay instead of synthetic traffic")
+    parser.add_argument("--grace", type=float, default=30, help="seconds to wait for outstanding answers")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep", action="store_true", help="keep the bot's scratch directory")
+    asyncio.run(run(parser.parse_args()))
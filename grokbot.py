@@ -1,19 +1,31 @@
+import asyncio
+import collections
+import copy
 import configparser
-import socket
 import ssl
 import time
 import requests
 import json
 import os
-import random
 import datetime
+import heapq
 import re
+import itertools
+import urllib.parse
+import random
+import base64
+import email.utils
+import logging
+import logging.handlers
+import queue
+from requests.adapters import HTTPAdapter
 
 # Load configuration
 config = configparser.ConfigParser()
 config.read("grok.conf")
 
 XAI_API_KEY = config.get('grok', 'api_key')
+api_base = config.get('grok', 'api_base', fallback='https://api.x.ai/v1').rstrip('/')
 model = config.get('chatcompletion', 'model')
 context_file = config.get('chatcompletion', 'context_file')
 temperature = config.getfloat('chatcompletion', 'temperature')
@@ -26,136 +38,1328 @@ use_top_p = config.getboolean('chatcompletion', 'use_top_p')
 use_frequency_penalty = config.getboolean('chatcompletion', 'use_frequency_penalty')
 use_presence_penalty = config.getboolean('chatcompletion', 'use_presence_penalty')
 use_live_search = config.getboolean('chatcompletion', 'use_live_search')
-
-server = config.get('irc', 'server')
-port = config.getint('irc', 'port')
-use_ssl = config.getboolean('irc', 'ssl')
-channels = config.get('irc', 'channels').split(',')
-nickname = config.get('irc', 'nickname')
-ident = config.get('irc', 'ident')
-realname = config.get('irc', 'realname')
+max_input_tokens = config.getint('chatcompletion', 'max_input_tokens', fallback=8000)
+recent_memory_turns = config.getint('chatcompletion', 'recent_memory_turns', fallback=10)
+search_cache_ttl = config.getfloat('chatcompletion', 'search_cache_ttl', fallback=300)
+search_cache_size = config.getint('chatcompletion', 'search_cache_size', fallback=100)
+use_streaming = config.getboolean('chatcompletion', 'stream', fallback=True)
+memory_max_entries = config.getint('chatcompletion', 'memory_max_entries', fallback=200)
+max_concurrent_requests = config.getint('chatcompletion', 'max_concurrent_requests', fallback=4)
+summary_model = config.get('chatcompletion', 'summary_model', fallback=model)
+summary_threshold = config.getint('chatcompletion', 'summary_threshold', fallback=30)
+summary_max_tokens = config.getint('chatcompletion', 'summary_max_tokens', fallback=300)
+
+network_names = [n.strip() for n in config.get('irc', 'networks', fallback='').split(',') if n.strip()]
 keywords = [k.strip() for k in config.get('irc', 'keywords').split(',')]
 ignore_file = config.get('irc', 'ignore_file')
+file_check_interval = config.getfloat('irc', 'file_check_interval', fallback=5)
+log_retention_hours = config.getfloat('irc', 'log_retention_hours', fallback=72)
+log_max_entries = config.getint('irc', 'log_max_entries', fallback=5000)
+log_flush_interval = config.getfloat('irc', 'log_flush_interval', fallback=5)
+
+http_pool_size = config.getint('http', 'pool_size', fallback=10)
+http_max_retries = config.getint('http', 'max_retries', fallback=3)
+http_backoff_base = config.getfloat('http', 'backoff_base', fallback=0.5)
+http_backoff_max = config.getfloat('http', 'backoff_max', fallback=10)
+breaker_threshold = config.getint('http', 'breaker_threshold', fallback=5)
+breaker_cooldown = config.getfloat('http', 'breaker_cooldown', fallback=30)
+
+geocoding_url = config.get('weather', 'geocoding_url', fallback='https://geocoding-api.open-meteo.com/v1/search')
+forecast_url = config.get('weather', 'forecast_url', fallback='https://api.open-meteo.com/v1/forecast')
+geocode_ttl = config.getfloat('weather', 'geocode_ttl', fallback=604800)
+geocode_negative_ttl = config.getfloat('weather', 'geocode_negative_ttl', fallback=3600)
+geocode_cache_size = config.getint('weather', 'geocode_cache_size', fallback=1000)
+geocode_cache_file = config.get('weather', 'geocode_cache_file', fallback='geocode_cache.json')
+forecast_ttl = config.getfloat('weather', 'forecast_ttl', fallback=600)
+forecast_cache_size = config.getint('weather', 'forecast_cache_size', fallback=200)
+
+log_level = config.get('logging', 'level', fallback='INFO').upper()
+log_file = config.get('logging', 'file', fallback='grokbot.log')
+log_max_bytes = config.getint('logging', 'max_bytes', fallback=10 * 1024 * 1024)
+log_backup_count = config.getint('logging', 'backup_count', fallback=5)
+log_console = config.getboolean('logging', 'console', fallback=True)
+
+metrics_host = config.get('metrics', 'host', fallback='127.0.0.1')
+metrics_port = config.getint('metrics', 'port', fallback=0)
 
-authorized_users = [u.strip() for u in config.get('security', 'authorized_users').split(',')]
 allowed_modes = [m.strip() for m in config.get('security', 'allowed_modes').split(',')]
 
+max_in_flight = config.getint('scheduler', 'max_in_flight', fallback=max_concurrent_requests)
+queue_per_user = config.getint('scheduler', 'queue_per_user', fallback=3)
+queue_per_channel = config.getint('scheduler', 'queue_per_channel', fallback=10)
+question_deadline = config.getfloat('scheduler', 'deadline', fallback=60)
+channel_weights = [w.strip() for w in config.get('scheduler', 'channel_weights', fallback='').split(',') if w.strip()]
+
+# IRC networks: [irc] holds the defaults and each name listed in `networks` gets an
+# [irc:name] section overriding them. The name qualifies channel log and memory keys,
+# so a single unnamed network keeps bare keys.
+class Network:
+    def __init__(self, name):
+        self.name = name
+        section = f"irc:{name}" if name else "irc"
+        def option(getter, key, fallback=None):
+            return getter(section, key, fallback=getter('irc', key, fallback=fallback))
+        self.server = option(config.get, 'server')
+        self.port = option(config.getint, 'port')
+        self.use_ssl = option(config.getboolean, 'ssl')
+        self.channels = [c.strip() for c in option(config.get, 'channels').split(',') if c.strip()]
+        self.nickname = option(config.get, 'nickname')
+        self.ident = option(config.get, 'ident')
+        self.realname = option(config.get, 'realname')
+        self.flood_burst = option(config.getint, 'flood_burst', 5)
+        self.flood_rate = option(config.getfloat, 'flood_rate', 1.0)
+        self.send_queue_size = option(config.getint, 'send_queue_size', 200)
+        self.reconnect_delay = option(config.getfloat, 'reconnect_delay', 1.0)
+        self.reconnect_max_delay = option(config.getfloat, 'reconnect_max_delay', 60)
+        self.ping_interval = option(config.getfloat, 'ping_interval', 15)
+        self.ping_timeout = option(config.getfloat, 'ping_timeout', 10)
+        self.sasl_username = option(config.get, 'sasl_username', '')
+        self.sasl_password = option(config.get, 'sasl_password', '')
+        # Nicks are only meaningful per network, so each one can have its own admins
+        admins = config.get(section, 'authorized_users', fallback=config.get('security', 'authorized_users'))
+        self.authorized_users = [u.strip() for u in admins.split(',')]
+        self.label = name or self.server
+        # Session state that outlives any one connection
+        self.chat_sessions = {}
+        self.outbound = None
+        self.lag = None
+
+    def qualify(self, key):
+        return f"{self.name}/{key}" if self.name else key
+
+networks = [Network(name) for name in network_names] or [Network("")]
+nicknames = [network.nickname for network in networks]
+
+# Logging: records are queued and written by a background thread, to the console and to a
+# rotating JSON-lines file, so the event loop never waits on log I/O
+log = logging.getLogger("grokbot")
+log_irc = logging.getLogger("grokbot.irc")
+log_api = logging.getLogger("grokbot.api")
+log_http = logging.getLogger("grokbot.http")
+log_store = logging.getLogger("grokbot.store")
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry)
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    # The stock prepare() folds the traceback into the message; keep it in exc_text instead,
+    # which the console formatter still appends and the JSON formatter writes as its own field
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+class LazyJSON:
+    # Only serialized if the record is actually emitted
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return json.dumps(self.obj, indent=4)
+
+def setup_logging():
+    handlers = []
+    if log_console:
+        console = logging.StreamHandler()
+        console.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+        handlers.append(console)
+    if log_file:
+        file_handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=log_max_bytes, backupCount=log_backup_count)
+        file_handler.setFormatter(JSONFormatter())
+        handlers.append(file_handler)
+
+    log_queue = queue.SimpleQueue()
+    log.addHandler(LogQueueHandler(log_queue))
+    log.setLevel(log_level)
+    log.propagate = False
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+# Metrics: counters, latency histograms and gauges, rendered in Prometheus text format
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self, **labels):
+        wanted = set(labels.items())
+        return sum(value for key, value in self.values.items() if wanted <= set(key))
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{format_labels(key)} {value}")
+        return lines
+
+class Histogram:
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, help_text, buckets=BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+        counts = series[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    def time(self, **labels):
+        return StageTimer(self, labels)
+
+    def quantile(self, q, **labels):
+        # Upper bound of the bucket holding the q-th observation
+        series = self.series.get(tuple(sorted(labels.items())))
+        if not series or not series[2]:
+            return None
+        rank = q * series[2]
+        seen = 0
+        for bound, count in zip(self.buckets, series[0]):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{format_labels(key + (('le', bound),))} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels(key + (('le', '+Inf'),))} {count}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(key)} {count}")
+        return lines
+
+class StageTimer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+class Gauge:
+    # Value read from a callback at render time; the callback returns a number or {label value: number}
+    def __init__(self, name, help_text, fn, label=None):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+        self.label = label
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        value = self.fn()
+        if self.label:
+            for label_value, number in sorted(value.items()):
+                lines.append(f"{self.name}{format_labels(((self.label, label_value),))} {number}")
+        else:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+class RateMeter:
+    # Events per second over a sliding window of one-second buckets
+    def __init__(self, window=60):
+        self.window = window
+        self.buckets = collections.deque()
+
+    def mark(self):
+        now = int(time.monotonic())
+        if self.buckets and self.buckets[-1][0] == now:
+            self.buckets[-1][1] += 1
+        else:
+            self.buckets.append([now, 1])
+        while self.buckets[0][0] <= now - self.window:
+            self.buckets.popleft()
+
+    def rate(self):
+        cutoff = int(time.monotonic()) - self.window
+        return sum(count for second, count in self.buckets if second > cutoff) / self.window
+
+messages_received = Counter("grokbot_messages_received_total", "IRC lines received, by command")
+questions_total = Counter("grokbot_questions_total", "Questions answered")
+questions_dropped = Counter("grokbot_questions_dropped_total", "Questions dropped before answering, by reason")
+api_calls = Counter("grokbot_api_calls_total", "xAI API calls, by endpoint")
+api_errors = Counter("grokbot_api_errors_total", "xAI API failures, by kind")
+reconnects = Counter("grokbot_reconnects_total", "IRC reconnect attempts, by network")
+lines_dropped = Counter("grokbot_send_dropped_total", "Chat lines dropped because the send queue was full")
+stage_seconds = Histogram("grokbot_stage_seconds", "Time spent in each stage of answering a question")
+message_rate = RateMeter()
+metrics = [messages_received, questions_total, questions_dropped, api_calls, api_errors, reconnects, stage_seconds]
+
+def render_metrics():
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+async def handle_metrics_request(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+            pass
+        path = request_line.split()[1].decode() if len(request_line.split()) > 1 else ""
+        if path.split("?")[0] == "/metrics":
+            status, body = "200 OK", render_metrics()
+        else:
+            status, body = "404 Not Found", "not found\n"
+        payload = body.encode("UTF-8")
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError) as e:
+        log.debug("Metrics request failed: %s", e)
+    finally:
+        writer.close()
+
+# Intent detection: every trigger keyword and question pattern compiled into one regex
+INTENT_PATTERNS = {
+    "weather": ["weather", "forecast", "temperature", "how hot", "how cold", "rain", "raining"],
+    "time": ["what time", "current time", "what date", "today's date", "what day", "date today", "time is it"],
+    "news": ["news", "latest", "trending", "headline", "headlines", "what happened",
+             "update on", "current events", "search", "find out", "look up",
+             "who won", "score", "scores", "stock", "stocks", "price of"],
+    "summary": ["summarize", "summary"],
+    "what_did": ["what did"],
+}
+
+def trie_regex(phrases):
+    # Build an alternation that shares common prefixes, so matching cost barely grows with phrase count
+    trie = {}
+    for phrase in phrases:
+        node = trie
+        for ch in phrase:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def build(node):
+        branches = []
+        for ch, child in sorted(node.items()):
+            if ch:
+                branches.append((r"\s+" if ch == " " else re.escape(ch)) + build(child))
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        return f"(?:{body})?" if "" in node else body
+
+    return build(trie)
+
+class IntentMatcher:
+    def __init__(self, intents):
+        self.lookup = {}
+        for intent, phrases in intents.items():
+            for phrase in phrases:
+                phrase = " ".join(phrase.lower().split())
+                if phrase:
+                    self.lookup.setdefault(phrase, set()).add(intent)
+        self.pattern = re.compile(r"(?<!\w)(?:" + trie_regex(self.lookup) + r")(?!\w)")
+
+    def match(self, text):
+        """Return {intent: [matched phrases]} for every pattern found in text."""
+        found = {}
+        for m in self.pattern.finditer(text.lower()):
+            phrase = " ".join(m.group(0).split())
+            for intent in self.lookup[phrase]:
+                found.setdefault(intent, []).append(phrase)
+        return found
+
+intent_matcher = IntentMatcher({"trigger": keywords + nicknames, **INTENT_PATTERNS})
+
 # Memory and log files
-MEMORY_FILE = "chat_memory.json"
-CHANNEL_LOG_FILE = "channel_logs.json"
+MEMORY_DIR = "chat_memory"
+LEGACY_MEMORY_FILE = "chat_memory.json"
+CHANNEL_LOG_FILE = "channel_logs.jsonl"
+LEGACY_CHANNEL_LOG_FILE = "channel_logs.json"
 OPTOUT_FILE = "optout_users.json"
 
-# User-specific memory functions
-def load_memory():
-    if os.path.exists(MEMORY_FILE):
-        with open(MEMORY_FILE, "r") as f:
-            return json.load(f)
-    return {}
-
-def save_memory(memory):
-    with open(MEMORY_FILE, "w") as f:
-        json.dump(memory, f)
-
-def get_recent_memory(memory, user, limit=50):
-    return memory.get(user, [])[-limit:]
-
-def add_to_memory(memory, user, role, content):
-    if user not in memory:
-        memory[user] = []
-    memory[user].append({"role": role, "content": content})
-    save_memory(memory)
-
-# Channel log functions
-def load_channel_logs():
-    if os.path.exists(CHANNEL_LOG_FILE):
-        with open(CHANNEL_LOG_FILE, "r") as f:
-            logs = json.load(f)
-        one_day_ago = datetime.datetime.now() - datetime.timedelta(hours=72)
-        return [log for log in logs if datetime.datetime.fromisoformat(log["timestamp"]) > one_day_ago]
-    return []
-
-def save_channel_logs(logs):
-    with open(CHANNEL_LOG_FILE, "w") as f:
-        json.dump(logs, f)
-
-def add_to_channel_logs(channel, user, message):
-    optout_users = load_optout_users()
-    if user not in optout_users:
-        logs = load_channel_logs()
-        timestamp = datetime.datetime.now()
-        logs.append({
+# User-specific memory: bounded per-user history, loaded on first use and
+# persisted as one append-only JSONL file per user. Once a history passes
+# summary_threshold entries, a background worker folds all but the newest
+# keep_turns into a rolling summary, stored as a "summary" line in the same file.
+class MemoryStore:
+    def __init__(self, directory, max_entries, summary_threshold=0, keep_turns=10):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.summary_threshold = summary_threshold
+        self.keep_turns = keep_turns
+        self.users = {}
+        self.summaries = {}
+        self.file_lines = {}
+        self.to_summarize = set()
+        self.summary_ready = asyncio.Event()
+
+    def path(self, user):
+        return os.path.join(self.directory, urllib.parse.quote(user, safe="") + ".jsonl")
+
+    def get(self, user):
+        history = self.users.get(user)
+        if history is None:
+            history = collections.deque(maxlen=self.max_entries)
+            lines = 0
+            path = self.path(user)
+            if os.path.exists(path):
+                with open(path, "r") as f:
+                    for line in f:
+                        lines += 1
+                        try:
+                            entry = json.loads(line)
+                        except json.JSONDecodeError:
+                            continue
+                        if entry.get("role") == "summary":
+                            self.summaries[user] = entry["content"]
+                        else:
+                            history.append(entry)
+            self.users[user] = history
+            self.file_lines[user] = lines
+        return history
+
+    def recent(self, user, limit=50):
+        history = self.get(user)
+        return list(itertools.islice(history, max(len(history) - limit, 0), None))
+
+    def summary(self, user):
+        self.get(user)
+        return self.summaries.get(user, "")
+
+    def add(self, user, role, content):
+        entry = {"role": role, "content": content}
+        history = self.get(user)
+        history.append(entry)
+        with open(self.path(user), "a") as f:
+            f.write(json.dumps(entry) + "\n")
+        self.file_lines[user] += 1
+        if self.file_lines[user] > 2 * self.max_entries:
+            self.compact(user)
+        if self.summary_threshold and len(history) > self.summary_threshold:
+            self.to_summarize.add(user)
+            self.summary_ready.set()
+
+    def compact(self, user):
+        # Rewrite a user's file with only the entries still kept in memory
+        history = self.users[user]
+        entries = list(history)
+        if self.summaries.get(user):
+            entries.insert(0, {"role": "summary", "content": self.summaries[user]})
+        path = self.path(user)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write("".join(json.dumps(entry) + "\n" for entry in entries))
+        os.replace(tmp_path, path)
+        self.file_lines[user] = len(entries)
+
+    def compact_all(self):
+        for user, history in list(self.users.items()):
+            if self.file_lines[user] > len(history) + bool(self.summaries.get(user)):
+                self.compact(user)
+
+    async def summarize(self, user, summarizer):
+        history = self.get(user)
+        # Turns added during the previous summary call re-queue the user; wait until enough pile up
+        if len(history) <= self.summary_threshold:
+            return
+        older = list(history)[:len(history) - self.keep_turns]
+        if not older:
+            return
+        summary = await summarizer(self.summaries.get(user, ""), older)
+        if not summary:
+            return
+        # New turns may have arrived meanwhile; drop only the ones that were summarized
+        for entry in older:
+            if history and history[0] is entry:
+                history.popleft()
+        self.summaries[user] = summary
+        self.compact(user)
+        log_store.debug("Summarized %d turns for %s", len(older), user)
+
+    async def summarize_loop(self, summarizer):
+        while True:
+            await self.summary_ready.wait()
+            self.summary_ready.clear()
+            while self.to_summarize:
+                user = self.to_summarize.pop()
+                try:
+                    await self.summarize(user, summarizer)
+                except Exception as e:
+                    log_store.error("Failed to summarize memory for %s: %s", user, e)
+
+    async def compact_loop(self, interval=3600):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.compact_all()
+            except OSError as e:
+                log_store.error("Failed to compact memory: %s", e)
+
+    def load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        # One-time migration from the old single chat_memory.json
+        if os.path.exists(LEGACY_MEMORY_FILE) and not os.listdir(self.directory):
+            with open(LEGACY_MEMORY_FILE, "r") as f:
+                legacy = json.load(f)
+            for user, entries in legacy.items():
+                self.users[user] = collections.deque(entries, maxlen=self.max_entries)
+                self.compact(user)
+            self.users.clear()
+            self.file_lines.clear()
+
+memory_store = MemoryStore(MEMORY_DIR, memory_max_entries, summary_threshold, recent_memory_turns)
+
+# Channel log store: per-channel ring buffers in memory, persisted to an append-only JSONL file
+LOG_TOKEN_RE = re.compile(r"\w+")
+NICK_TOKEN_RE = re.compile(r"[\w\[\]\\`^{}|-]+")
+SEARCH_TERM_RE = re.compile(r'"([^"]*)"|(\S+)')
+SEARCH_WINDOW = 200
+SEARCH_SCAN_LIMIT = 5000
+
+def tokenize(text):
+    return LOG_TOKEN_RE.findall(text.lower())
+
+class LogRecord:
+    __slots__ = ("seq", "entry", "time", "user_key", "tokens", "triggered")
+
+    def __init__(self, seq, entry, timestamp=None):
+        self.seq = seq
+        self.entry = entry
+        self.time = timestamp or datetime.datetime.fromisoformat(entry["timestamp"]).timestamp()
+        self.user_key = irc_lower(entry["user"])
+        message = entry["message"].lower()
+        self.tokens = frozenset(LOG_TOKEN_RE.findall(message))
+        self.triggered = "trigger" in intent_matcher.match(message)
+
+# One channel's records plus postings by user, by token and for lines that mention a keyword.
+# Records are only ever evicted oldest-first, so they are always at the head of every posting.
+class ChannelLog:
+    def __init__(self):
+        self.records = collections.deque()
+        self.by_user = {}
+        self.by_token = {}
+        self.triggered = collections.deque()
+
+    def append(self, record):
+        self.records.append(record)
+        self.by_user.setdefault(record.user_key, collections.deque()).append(record)
+        for token in record.tokens:
+            self.by_token.setdefault(token, collections.deque()).append(record)
+        if record.triggered:
+            self.triggered.append(record)
+
+    def evict(self):
+        record = self.records.popleft()
+        self.pop_posting(self.by_user, record.user_key)
+        for token in record.tokens:
+            self.pop_posting(self.by_token, token)
+        if record.triggered:
+            self.triggered.popleft()
+
+    @staticmethod
+    def pop_posting(postings, key):
+        posting = postings[key]
+        posting.popleft()
+        if not posting:
+            del postings[key]
+
+def parse_search_query(query):
+    terms = []
+    phrases = []
+    user = None
+    channel = None
+    for match in SEARCH_TERM_RE.finditer(query):
+        phrase, word = match.groups()
+        if phrase is not None:
+            tokens = tokenize(phrase)
+            if tokens:
+                phrases.append(" ".join(tokens))
+                terms.extend(tokens)
+        elif word.lower().startswith(("from:", "user:")):
+            user = word.split(":", 1)[1]
+        elif word.lower().startswith("in:"):
+            channel = word.split(":", 1)[1]
+        elif word.startswith("#"):
+            channel = word
+        else:
+            terms.extend(tokenize(word))
+    return terms, phrases, user, channel
+
+class ChannelLogStore:
+    def __init__(self, path, retention_hours, max_entries, flush_interval):
+        self.path = path
+        self.retention = retention_hours * 3600
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.channels = {}
+        self.seq = itertools.count()
+        self.pending = []
+        self.file_lines = 0
+
+    def cutoff(self):
+        return time.time() - self.retention
+
+    def append(self, entry, timestamp=None):
+        channel_key = (entry.get("network", ""), irc_lower(entry["channel"]))
+        log = self.channels.get(channel_key)
+        if log is None:
+            log = self.channels[channel_key] = ChannelLog()
+        log.append(LogRecord(next(self.seq), entry, timestamp))
+        cutoff = self.cutoff()
+        # The new record may itself be past the cutoff (a slow load), emptying the log
+        while log.records and (len(log.records) > self.max_entries or log.records[0].time < cutoff):
+            log.evict()
+
+    def add(self, channel, user, message, network="", when=None):
+        now = when or datetime.datetime.now()
+        if now.timestamp() < self.cutoff():
+            return
+        entry = {
             "channel": channel,
             "user": user,
             "message": message,
-            "timestamp": timestamp.isoformat()
-        })
-        logs = logs[-500:]
-        save_channel_logs(logs)
-
-# Opt-out functions
-def load_optout_users():
-    if os.path.exists(OPTOUT_FILE):
-        with open(OPTOUT_FILE, "r") as f:
-            return json.load(f)
-    return []
-
-def save_optout_users(users):
-    with open(OPTOUT_FILE, "w") as f:
-        json.dump(users, f)
-
-# Ignore functions
-def load_ignored_users():
-    if os.path.exists(ignore_file):
-        try:
-            with open(ignore_file, "r") as f:
-                return json.load(f)
-        except (json.JSONDecodeError, ValueError):
+            "timestamp": now.isoformat()
+        }
+        if network:
+            entry["network"] = network
+        self.append(entry, now.timestamp())
+        self.pending.append(entry)
+
+    def newest(self, postings):
+        # Merge posting lists newest first, skipping expired and duplicate records
+        cutoff = self.cutoff()
+        last_seq = None
+        merged = heapq.merge(*(reversed(p) for p in postings), key=lambda r: r.seq, reverse=True)
+        for record in merged:
+            if record.time < cutoff:
+                break
+            if record.seq != last_seq:
+                last_seq = record.seq
+                yield record
+
+    def latest(self, postings, limit):
+        records = list(itertools.islice(self.newest(postings), limit))
+        return [record.entry for record in reversed(records)]
+
+    def logs(self, network=None):
+        # Channel logs on one network, or on every network when none is given
+        if network is None:
+            return list(self.channels.values())
+        return [log for (log_network, _), log in self.channels.items() if log_network == network]
+
+    def recent(self, limit, network=None):
+        return self.latest([log.records for log in self.logs(network)], limit)
+
+    def by_user(self, user, limit, network=None):
+        user_key = irc_lower(user)
+        return self.latest([log.by_user[user_key] for log in self.logs(network) if user_key in log.by_user], limit)
+
+    def relevant(self, user, limit, network=None):
+        # Lines from the user or mentioning one of the bot's keywords
+        user_key = irc_lower(user)
+        logs = self.logs(network)
+        postings = [log.triggered for log in logs]
+        postings.extend(log.by_user[user_key] for log in logs if user_key in log.by_user)
+        return self.latest(postings, limit)
+
+    def find_user(self, text, exclude=None, network=None):
+        # The most recently active logged nick mentioned in text
+        exclude_key = irc_lower(exclude) if exclude else None
+        best = None
+        for token in set(NICK_TOKEN_RE.findall(irc_lower(text))):
+            if token == exclude_key:
+                continue
+            for log in self.logs(network):
+                posting = log.by_user.get(token)
+                if posting and (best is None or posting[-1].seq > best.seq):
+                    best = posting[-1]
+        return best.entry["user"] if best else None
+
+    def search(self, query, limit=3, network=None):
+        """Find log lines containing every query word.
+
+        Supports "quoted phrases", from:nick and in:#channel (or a bare #channel).
+        Lines containing the query verbatim rank first, then newer lines.
+        """
+        terms, phrases, user, channel = parse_search_query(query)
+        if not terms and not user:
             return []
-    return []
+        if channel:
+            logs = [log for (log_network, channel_key), log in self.channels.items()
+                    if channel_key == irc_lower(channel) and network in (None, log_network)]
+        else:
+            logs = self.logs(network)
+        required = set(terms)
+        postings = []
+        for log in logs:
+            if user:
+                posting = log.by_user.get(irc_lower(user))
+            else:
+                # Walk the shortest posting and check the other words against each record
+                candidates = [log.by_token.get(term) for term in required]
+                posting = None if None in candidates else min(candidates, key=len)
+            if posting:
+                postings.append(posting)
+
+        # Rank verbatim matches first, but once there are enough results only look a
+        # bounded number of candidates further back for verbatim ones. A rare combination
+        # of common words is only looked for among the newest lines holding the rarest one.
+        exact_text = " ".join(terms)
+        check_text = bool(phrases) or len(terms) > 1
+        exact = []
+        others = []
+        window = SEARCH_WINDOW
+        for scanned, record in enumerate(self.newest(postings)):
+            if scanned >= SEARCH_SCAN_LIMIT:
+                break
+            if len(others) >= limit:
+                window -= 1
+                if window < 0:
+                    break
+            if not required <= record.tokens:
+                continue
+            if check_text:
+                text = " ".join(tokenize(record.entry["message"]))
+                if not all(phrase in text for phrase in phrases):
+                    continue
+                is_exact = exact_text in text
+            else:
+                is_exact = True
+            if is_exact:
+                exact.append(record.entry)
+                if len(exact) >= limit:
+                    break
+            elif len(others) < limit:
+                others.append(record.entry)
+        return (exact + others)[:limit]
+
+    def entries(self):
+        # All retained entries across channels, oldest first
+        cutoff = self.cutoff()
+        merged = heapq.merge(*(log.records for log in self.channels.values()), key=lambda r: r.seq)
+        return [record.entry for record in merged if record.time >= cutoff]
+
+    def __len__(self):
+        return sum(len(log.records) for log in self.channels.values())
+
+    def load(self):
+        logs = []
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                for line in f:
+                    try:
+                        logs.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue
+        elif os.path.exists(LEGACY_CHANNEL_LOG_FILE):
+            with open(LEGACY_CHANNEL_LOG_FILE, "r") as f:
+                logs = json.load(f)
+        cutoff = datetime.datetime.fromtimestamp(self.cutoff())
+        for log in logs:
+            if datetime.datetime.fromisoformat(log["timestamp"]) > cutoff:
+                self.append(log)
+        self.compact()
+
+    def compact(self):
+        # Rewrite the file with only the retained entries
+        logs = self.entries()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for log in logs:
+                f.write(json.dumps(log) + "\n")
+        os.replace(tmp_path, self.path)
+        self.file_lines = len(logs)
+
+    def write_batch(self, batch):
+        with open(self.path, "a") as f:
+            f.write("".join(json.dumps(log) + "\n" for log in batch))
+        self.file_lines += len(batch)
+        if self.file_lines > 2 * len(self) + 1000:
+            self.compact()
+
+    def flush(self):
+        batch, self.pending = self.pending, []
+        if batch:
+            self.write_batch(batch)
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError as e:
+                log_store.error("Failed to write channel logs: %s", e)
 
-def save_ignored_users(users):
-    with open(ignore_file, "w") as f:
-        json.dump(users, f)
+channel_logs = ChannelLogStore(CHANNEL_LOG_FILE, log_retention_hours, log_max_entries, log_flush_interval)
 
-# External Context
-def load_context():
-    try:
-        with open(context_file, "r") as f:
-            return f.read().strip()
-    except FileNotFoundError:
-        print(f"Warning: {context_file} not found, using empty context.")
-        return ""
+def add_to_channel_logs(channel, user, message, network, when=None):
+    # Nicks are only meaningful per network, so opt-outs are keyed by network/nick
+    if network.qualify(user) not in optout_users:
+        channel_logs.add(channel, user, message, network.name, when)
+
+# IRC nick comparison uses rfc1459 case mapping, where []\~ are the uppercase of {}|^
+IRC_CASEMAP = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\~", "abcdefghijklmnopqrstuvwxyz{}|^")
+
+def irc_lower(name):
+    return name.translate(IRC_CASEMAP)
+
+# Cached files, reloaded only when their mtime changes on disk
+class WatchedFile:
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+
+    def current_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def check(self):
+        mtime = self.current_mtime()
+        if mtime != self.mtime:
+            self.mtime = mtime
+            self.reload()
+            return True
+        return False
+
+    def force_reload(self):
+        self.mtime = self.current_mtime()
+        self.reload()
+
+class NickSetFile(WatchedFile):
+    def __init__(self, path):
+        super().__init__(path)
+        self.nicks = set()
+
+    def reload(self):
+        try:
+            with open(self.path, "r") as f:
+                self.nicks = {irc_lower(nick) for nick in json.load(f)}
+        except FileNotFoundError:
+            self.nicks = set()
+        except (json.JSONDecodeError, ValueError, TypeError):
+            log_store.warning("Could not parse %s, keeping previous list.", self.path)
+
+    def save(self):
+        with open(self.path, "w") as f:
+            json.dump(sorted(self.nicks), f)
+        self.mtime = self.current_mtime()
+
+    def __contains__(self, nick):
+        return irc_lower(nick) in self.nicks
+
+    def add(self, nick):
+        if nick not in self:
+            self.nicks.add(irc_lower(nick))
+            self.save()
+
+    def discard(self, nick):
+        if nick in self:
+            self.nicks.discard(irc_lower(nick))
+            self.save()
+
+class TextFile(WatchedFile):
+    def __init__(self, path):
+        super().__init__(path)
+        self.text = ""
+
+    def reload(self):
+        try:
+            with open(self.path, "r") as f:
+                self.text = f.read().strip()
+        except FileNotFoundError:
+            log_store.warning("%s not found, using empty context.", self.path)
+            self.text = ""
+
+optout_users = NickSetFile(OPTOUT_FILE)
+ignored_users = NickSetFile(ignore_file)
+context_text = TextFile(context_file)
+watched_files = [optout_users, ignored_users, context_text]
+
+def reload_files(force=False):
+    for watched in watched_files:
+        if force:
+            watched.force_reload()
+        elif watched.check():
+            log_store.info("Reloaded %s", watched.path)
+
+async def watch_files():
+    while True:
+        await asyncio.sleep(file_check_interval)
+        reload_files()
 
 # Clean citations from API responses
+CITATION_LINK_RE = re.compile(r'\[\[\d+\]\]\((https?://\S+?)\)')
+MARKDOWN_LINK_RE = re.compile(r'\[([^\]]+)\]\((https?://\S+?)\)')
+GROK_RENDER_RE = re.compile(r'<grok:render[^>]*>.*?</grok:render>', re.DOTALL)
+ARGUMENT_TAG_RE = re.compile(r'<argument[^>]*>.*?</argument>', re.DOTALL)
+EXTRA_SPACES_RE = re.compile(r'  +')
+
 def clean_citations(text):
     # Convert markdown citations [[1]](url) to plain URLs
-    text = re.sub(r'\[\[\d+\]\]\((https?://\S+?)\)', r' \1', text)
+    text = CITATION_LINK_RE.sub(r' \1', text)
     # Also handle standard markdown links [text](url)
-    text = re.sub(r'\[([^\]]+)\]\((https?://\S+?)\)', r'\1 \2', text)
+    text = MARKDOWN_LINK_RE.sub(r'\1 \2', text)
     # Strip grok XML citation tags
-    text = re.sub(r'<grok:render[^>]*>.*?</grok:render>', '', text, flags=re.DOTALL)
+    text = GROK_RENDER_RE.sub('', text)
     # Strip any leftover <argument> tags
-    text = re.sub(r'<argument[^>]*>.*?</argument>', '', text, flags=re.DOTALL)
+    text = ARGUMENT_TAG_RE.sub('', text)
     # Clean up extra whitespace
-    text = re.sub(r'  +', ' ', text).strip()
+    text = EXTRA_SPACES_RE.sub(' ', text).strip()
     return text
 
-# Get weather
-def get_weather(location):
+# HTTP client: one pooled keep-alive session shared by every API call, with retries,
+# a circuit breaker per host and per-endpoint latency/error counters
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    pass
+
+class CircuitBreaker:
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        state = self.state
+        if state == "open":
+            return False
+        if state == "half-open":
+            # Let a single trial call through; its result closes or re-opens the breaker
+            self.opened_at = time.monotonic()
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        # A failed trial call while half-open re-opens the breaker for another cooldown
+        if self.failures >= self.threshold or self.opened_at is not None:
+            self.opened_at = time.monotonic()
+
+class EndpointStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def record(self, latency):
+        self.requests += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def __str__(self):
+        avg = self.total_latency / self.requests if self.requests else 0
+        return (f"{self.requests} requests, {self.errors} errors, {self.timeouts} timeouts, "
+                f"{self.retries} retries, avg {avg:.2f}s, max {self.max_latency:.2f}s")
+
+def parse_retry_after(value):
+    if not value:
+        return None
     try:
-        geo_url = f"https://geocoding-api.open-meteo.com/v1/search?name={requests.utils.quote(location)}&count=1"
-        geo_resp = requests.get(geo_url, timeout=10).json()
-        if "results" not in geo_resp or not geo_resp["results"]:
-            return f"Could not find location: {location}"
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((when - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0)
+
+class HTTPClient:
+    def __init__(self, pool_size, max_retries, backoff_base, backoff_max, breaker_threshold, breaker_cooldown):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.breakers = {}
+        self.stats = {}
+
+    def breaker(self, host):
+        if host not in self.breakers:
+            self.breakers[host] = CircuitBreaker(self.breaker_threshold, self.breaker_cooldown)
+        return self.breakers[host]
+
+    def endpoint_stats(self, endpoint):
+        if endpoint not in self.stats:
+            self.stats[endpoint] = EndpointStats()
+        return self.stats[endpoint]
+
+    def backoff(self, attempt):
+        # Full jitter: anywhere between zero and the exponential cap
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def request(self, method, url, **kwargs):
+        parsed = urllib.parse.urlsplit(url)
+        breaker = self.breaker(parsed.netloc)
+        stats = self.endpoint_stats(parsed.netloc + parsed.path)
+
+        for attempt in range(self.max_retries + 1):
+            if not breaker.allow():
+                raise CircuitOpenError(f"Circuit open for {parsed.netloc}, not calling {parsed.path}")
+            if attempt:
+                stats.retries += 1
+            start = time.monotonic()
+            try:
+                response = await asyncio.to_thread(self.session.request, method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                stats.record(time.monotonic() - start)
+                stats.errors += 1
+                if isinstance(e, requests.exceptions.Timeout):
+                    stats.timeouts += 1
+                breaker.record_failure()
+                # A POST that timed out mid-read may already be running (and billed) upstream
+                if attempt == self.max_retries or (method.upper() not in IDEMPOTENT_METHODS
+                                                   and isinstance(e, requests.exceptions.ReadTimeout)):
+                    raise
+                delay = self.backoff(attempt)
+                log_http.warning("HTTP %s %s failed (%s), retrying in %.1fs", method, url, e, delay)
+            else:
+                stats.record(time.monotonic() - start)
+                if response.status_code not in RETRY_STATUSES:
+                    breaker.record_success()
+                    if response.status_code >= 400:
+                        stats.errors += 1
+                    return response
+                stats.errors += 1
+                # 429 means we're being rate limited, not that the host is down
+                if response.status_code != 429:
+                    breaker.record_failure()
+                delay = parse_retry_after(response.headers.get("Retry-After"))
+                if delay is None:
+                    delay = self.backoff(attempt)
+                if attempt == self.max_retries or delay > self.backoff_max:
+                    return response
+                log_http.warning("HTTP %s %s returned %s, retrying in %.1fs", method, url, response.status_code, delay)
+            await asyncio.sleep(delay)
+
+http_client = HTTPClient(http_pool_size, http_max_retries, http_backoff_base, http_backoff_max,
+                         breaker_threshold, breaker_cooldown)
+
+# Caching helpers
+MISSING = object()
+
+class TTLCache:
+    """LRU-bounded cache whose entries expire after a per-entry TTL (wall-clock seconds)."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.dirty = False
+
+    def get(self, key):
+        item = self.entries.get(key)
+        if item is None:
+            return MISSING
+        expires, value = item
+        if expires < time.time():
+            del self.entries[key]
+            return MISSING
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.entries[key] = (time.time() + (self.ttl if ttl is None else ttl), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        self.dirty = True
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self, path):
+        try:
+            with open(path, "r") as f:
+                items = json.load(f)
+        except FileNotFoundError:
+            return
+        except (json.JSONDecodeError, ValueError) as e:
+            log_store.warning("Could not parse %s: %s", path, e)
+            return
+        now = time.time()
+        for key, (expires, value) in items.items():
+            if expires > now:
+                self.entries[key] = (expires, value)
+        self.dirty = False
+
+    def save(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({key: list(item) for key, item in self.entries.items()}, f)
+        os.replace(tmp_path, path)
+        self.dirty = False
+
+class SingleFlight:
+    """Run at most one call per key at a time; concurrent callers share its result."""
+
+    def __init__(self):
+        self.calls = {}
+
+    async def run(self, key, fn):
+        call = self.calls.get(key)
+        if call is None:
+            call = self.calls[key] = asyncio.ensure_future(fn())
+            call.add_done_callback(lambda _: self.calls.pop(key, None))
+        return await asyncio.shield(call)
+
+    # For callers that produce the result themselves rather than through a coroutine
+    def pending(self, key):
+        return self.calls.get(key)
+
+    def begin(self, key):
+        # Claim the key and return the future to finish, or None if another call holds it
+        if key in self.calls:
+            return None
+        call = self.calls[key] = asyncio.get_running_loop().create_future()
+        return call
+
+    def finish(self, key, call, result):
+        if self.calls.get(key) is call:
+            del self.calls[key]
+        if not call.done():
+            call.set_result(result)
+
+async def iter_sse(response):
+    # Read a server-sent event stream on a worker thread and yield each JSON data payload
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    response.encoding = response.encoding or "utf-8"
+
+    def pump():
+        try:
+            for line in response.iter_lines(decode_unicode=True):
+                loop.call_soon_threadsafe(queue.put_nowait, line)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        loop.call_soon_threadsafe(queue.put_nowait, None)
+
+    reader = asyncio.create_task(asyncio.to_thread(pump))
+    try:
+        while True:
+            line = await queue.get()
+            if line is None:
+                break
+            if isinstance(line, Exception):
+                raise line
+            if not line.startswith("data:"):
+                continue
+            payload = line[5:].strip()
+            if payload == "[DONE]":
+                break
+            yield json.loads(payload)
+    finally:
+        response.close()
+        await asyncio.gather(reader, return_exceptions=True)
+
+# Turns streamed answer text into cleaned lines as soon as each one is complete
+CITATION_TAGS = (("<grok:render", "</grok:render>"), ("<argument", "</argument>"))
+
+def unclosed_tag_start(text):
+    # Position of a citation tag that hasn't closed yet (or may still be arriving), else None
+    hold = None
+    for open_tag, close_tag in CITATION_TAGS:
+        start = text.rfind(open_tag)
+        if start != -1 and text.find(close_tag, start) == -1:
+            hold = start if hold is None else min(hold, start)
+    last = text.rfind("<")
+    if last != -1 and any(tag.startswith(text[last:]) for pair in CITATION_TAGS for tag in pair):
+        hold = last if hold is None else min(hold, last)
+    return hold
+
+class LineAssembler:
+    def __init__(self, max_length=400):
+        self.max_length = max_length
+        self.buffer = ""
+
+    def feed(self, text, final=False):
+        self.buffer += text
+        # At the end of the answer nothing more is coming, so an unclosed tag is just text
+        hold = None if final else unclosed_tag_start(self.buffer)
+        ready = self.buffer if hold is None else self.buffer[:hold]
+        lines = []
+        while True:
+            newline = ready.find("\n")
+            if newline != -1:
+                lines.append(ready[:newline])
+                ready = ready[newline + 1:]
+            elif len(ready) > self.max_length:
+                cut = ready.rfind(" ", 0, self.max_length)
+                if cut <= 0:
+                    cut = self.max_length
+                lines.append(ready[:cut])
+                ready = ready[cut:]
+            else:
+                break
+        self.buffer = ready + ("" if hold is None else self.buffer[hold:])
+        with stage_seconds.time(stage="citation_clean"):
+            return [clean_citations(line) for line in lines]
+
+    def flush(self):
+        lines = self.feed("\n", final=True) if self.buffer else []
+        self.buffer = ""
+        return lines
+
+def wrap_bytes(text, limit):
+    # Split text into pieces of at most limit UTF-8 bytes, on spaces where possible
+    # and otherwise between code points
+    pieces = []
+    current = b""
+    for word in text.encode("UTF-8").split(b" "):
+        if not word:
+            continue
+        candidate = current + b" " + word if current else word
+        if len(candidate) <= limit:
+            current = candidate
+            continue
+        if current:
+            pieces.append(current)
+        while len(word) > limit:
+            cut = limit
+            while cut > 0 and word[cut] & 0xC0 == 0x80:
+                cut -= 1
+            pieces.append(word[:cut])
+            word = word[cut:]
+        current = word
+    if current:
+        pieces.append(current)
+    return [piece.decode("UTF-8") for piece in pieces]
+
+class ReplyPacker:
+    # Packs answer lines into as few messages as fit the byte budget: blank lines are
+    # dropped, short lines share a message and long ones wrap on word boundaries.
+    # The first line goes out as soon as it arrives so the user sees the answer start.
+    def __init__(self, budget):
+        self.budget = budget
+        self.pending = ""
+        self.started = False
+
+    def add(self, line):
+        line = line.strip()
+        if not line:
+            return []
+        if not self.started:
+            self.started = True
+            return wrap_bytes(line, self.budget)
+        if self.pending and len(self.pending.encode("UTF-8")) + 1 + len(line.encode("UTF-8")) <= self.budget:
+            self.pending += " " + line
+            return []
+        messages = [self.pending] if self.pending else []
+        pieces = wrap_bytes(line, self.budget)
+        messages.extend(pieces[:-1])
+        self.pending = pieces[-1]
+        return messages
+
+    def flush(self):
+        messages = [self.pending] if self.pending else []
+        self.pending = ""
+        return messages
+
+# Get weather, caching geocoding results for a long time and forecasts briefly
+geocode_cache = TTLCache(geocode_cache_size, geocode_ttl)
+forecast_cache = TTLCache(forecast_cache_size, forecast_ttl)
+weather_flights = SingleFlight()
+
+def normalize_location(location):
+    return " ".join(re.sub(r"[^\w\s,]", " ", location.lower()).replace(",", " , ").split())
+
+async def geocode(location):
+    key = normalize_location(location)
+    place = geocode_cache.get(key)
+    if place is not MISSING:
+        return place
+
+    async def fetch():
+        geo_url = f"{geocoding_url}?name={requests.utils.quote(location)}&count=1"
+        response = await http_client.request("GET", geo_url, timeout=10)
+        # An outage is not an unknown place; only a successful empty answer is cached
+        response.raise_for_status()
+        geo_resp = response.json()
+        if not geo_resp.get("results"):
+            # Remember unknown places too, for a shorter time
+            geocode_cache.set(key, None, geocode_negative_ttl)
+            return None
+        result = geo_resp["results"][0]
+        place = {
+            "latitude": result["latitude"],
+            "longitude": result["longitude"],
+            "name": result.get("name", location),
+            "country": result.get("country", "")
+        }
+        geocode_cache.set(key, place)
+        return place
+
+    return await weather_flights.run(("geocode", key), fetch)
 
-        place = geo_resp["results"][0]
-        lat = place["latitude"]
-        lon = place["longitude"]
-        name = place.get("name", location)
-        country = place.get("country", "")
+async def forecast(lat, lon):
+    lat, lon = round(lat, 2), round(lon, 2)
+    key = f"{lat},{lon}"
+    weather_resp = forecast_cache.get(key)
+    if weather_resp is not MISSING:
+        return weather_resp
 
+    async def fetch():
         weather_url = (
-            f"https://api.open-meteo.com/v1/forecast?"
+            f"{forecast_url}?"
             f"latitude={lat}&longitude={lon}"
             f"&current=temperature_2m,relative_humidity_2m,wind_speed_10m,weather_code"
             f"&daily=weather_code,temperature_2m_max,temperature_2m_min,precipitation_probability_max"
@@ -164,7 +1368,33 @@ def get_weather(location):
             f"&forecast_days=3"
             f"&timezone=auto"
         )
-        weather_resp = requests.get(weather_url, timeout=10).json()
+        response = await http_client.request("GET", weather_url, timeout=10)
+        response.raise_for_status()
+        weather_resp = response.json()
+        if "current" in weather_resp and "daily" in weather_resp:
+            forecast_cache.set(key, weather_resp)
+        return weather_resp
+
+    return await weather_flights.run(("forecast", key), fetch)
+
+async def save_geocode_cache_loop(interval=300):
+    while True:
+        await asyncio.sleep(interval)
+        if geocode_cache.dirty:
+            try:
+                geocode_cache.save(geocode_cache_file)
+            except OSError as e:
+                log_store.error("Failed to save geocode cache: %s", e)
+
+async def get_weather(location):
+    try:
+        place = await geocode(location)
+        if not place:
+            return f"Could not find location: {location}"
+
+        weather_resp = await forecast(place["latitude"], place["longitude"])
+        name = place["name"]
+        country = place["country"]
 
         current = weather_resp["current"]
         daily = weather_resp["daily"]
@@ -186,87 +1416,186 @@ def get_weather(location):
         return weather_info
 
     except Exception as e:
-        print(f"Weather error: {e}")
+        log_api.warning("Weather error: %s", e)
         return "Could not retrieve weather data."
 
-# Get Grok response
-def get_grok_response(question, recent_memory, user_nickname):
+# Limits how many xAI API calls are in flight at once
+api_semaphore = asyncio.Semaphore(max_concurrent_requests)
+
+# Prompt assembly: fit the conversation into a token budget, keeping the system prompt a stable prefix
+STATIC_INSTRUCTIONS = (
+    "When asked to summarize conversations, provide a concise summary of the main topics discussed in the "
+    "provided channel logs. When asked about what a specific user said, accurately quote or paraphrase their "
+    "most recent message from the logs. Use the provided conversation history for context."
+)
+
+def estimate_tokens(message):
+    # Roughly four bytes per token, plus a few tokens of per-message overhead
+    return len(message["content"].encode("UTF-8")) // 4 + 4
+
+def take_newest(messages, budget):
+    # Keep as many of the newest messages as fit, returned oldest first
+    kept = []
+    for message in reversed(messages):
+        cost = estimate_tokens(message)
+        if cost > budget:
+            break
+        budget -= cost
+        kept.append(message)
+    kept.reverse()
+    return kept, budget
+
+def build_prompt(dynamic_notes, question_message, memory, log_messages, budget, summary=""):
+    """Assemble the message list within budget tokens.
+
+    Order is the static system prompt (identical on every request, so upstream prompt
+    caching can reuse it), the summary of older conversation, the user's memory, channel
+    logs, then the per-request notes and the question. Space is handed out by priority:
+    the question and notes, the summary, recent memory, relevant logs, then older memory.
+    """
+    system_message = {"role": "system", "content": f"{context_text.text} {STATIC_INSTRUCTIONS}"}
+    notes_message = {"role": "system", "content": dynamic_notes}
+    budget -= estimate_tokens(system_message) + estimate_tokens(notes_message) + estimate_tokens(question_message)
+    summary_messages = []
+    if summary:
+        summary_messages, budget = take_newest([{"role": "system", "content": f"Summary of earlier conversation: {summary}"}], budget)
+
+    older_memory = memory[:-recent_memory_turns] if recent_memory_turns else memory
+    recent_memory = memory[len(older_memory):]
+    recent_memory, budget = take_newest(recent_memory, budget)
+    log_messages, budget = take_newest(log_messages, budget)
+    if len(recent_memory) == len(memory[len(older_memory):]):
+        older_memory, budget = take_newest(older_memory, budget)
+    else:
+        older_memory = []
+
+    return [system_message] + summary_messages + older_memory + recent_memory + log_messages + [notes_message, question_message]
+
+# Live search results, shared between people asking the same thing close together
+SEARCH_FILLER = {
+    "a", "an", "the", "is", "are", "was", "were", "be", "been", "do", "does", "did", "to", "of", "in",
+    "on", "at", "for", "with", "about", "from", "by", "and", "or", "any", "some", "me", "us", "you",
+    "i", "we", "can", "could", "please", "tell", "give", "show", "what", "whats", "s", "there",
+    "latest", "news", "new", "update", "updates", "happened", "happening", "going", "current",
+    "events", "search", "find", "out", "look", "up", "trending", "headline", "headlines", "today",
+}
+
+SEARCH_FILLER.update(tokenize(" ".join(keywords + nicknames)))
+
+def normalize_search_query(question):
+    return " ".join(sorted({word for word in tokenize(question) if word not in SEARCH_FILLER}))
+
+search_cache = TTLCache(search_cache_size, search_cache_ttl)
+search_flights = SingleFlight()
+
+async def find_search_result(key):
+    result = search_cache.get(key)
+    if result is not MISSING:
+        return result
+    pending = search_flights.pending(key)
+    if pending is not None:
+        return await asyncio.shield(pending)
+    return None
+
+def extract_source_urls(output):
+    source_urls = []
+    for item in output:
+        if item.get("type") == "search_result":
+            sr_url = item.get("url", "")
+            if sr_url and sr_url not in source_urls:
+                source_urls.append(sr_url)
+    return source_urls
+
+# Get Grok response, yielding the answer text as it arrives
+async def get_grok_response(question, recent_memory, user_nickname, intents, network="", summary=""):
     headers = {
         "Authorization": f"Bearer {XAI_API_KEY}",
         "Content-Type": "application/json"
     }
 
-    channel_logs = load_channel_logs()
     question_lower = question.lower()
 
     # Check for weather-related questions
     weather_info = ""
-    weather_patterns = ["weather", "forecast", "temperature", "how hot", "how cold", "rain"]
-    if any(pattern in question_lower for pattern in weather_patterns):
+    if "weather" in intents:
         location = None
         for prep in [" in ", " for ", " at "]:
             if prep in question_lower:
                 location = question.split(prep)[-1].strip().rstrip("?.,!")
                 break
         if location:
-            weather_info = get_weather(location)
+            with stage_seconds.time(stage="weather"):
+                weather_info = await get_weather(location)
 
     # Check for time/date questions
     time_info = ""
-    time_patterns = ["what time", "current time", "what date", "today's date", "what day", "date today", "time is it"]
-    if any(pattern in question_lower for pattern in time_patterns):
+    if "time" in intents:
         now = datetime.datetime.now()
         time_info = f"The current server date and time is: {now.strftime('%A, %B %d, %Y at %I:%M %p %Z')}"
 
-    # Build system prompt
-    system_prompt = f"{load_context()} Address the user as {user_nickname} in your responses. When asked to summarize conversations, provide a concise summary of the main topics discussed in the provided channel logs. When asked about what a specific user said, accurately quote or paraphrase their most recent message from the logs. Use the provided conversation history for context."
+    # Determine if this is a news/search query
+    needs_search = use_live_search and "news" in intents
+
+    # Reuse a recent or in-flight search for the same question; answering from it only needs chat completions
+    search_key = None
+    search_flight = None
+    search_result = None
+    search_text = ""
+    cached_sources = []
+    key = normalize_search_query(question) if needs_search else ""
+    # A question made only of filler words ("any news?") names no topic, so it is never shared
+    if key:
+        # If the flight we waited on failed, someone else may already be retrying it
+        while True:
+            cached = await find_search_result(key)
+            if cached:
+                search_text, cached_sources = cached
+                needs_search = False
+                log_api.info("Reusing live search results for '%s'", key)
+                break
+            search_flight = search_flights.begin(key)
+            if search_flight is not None:
+                search_key = key
+                break
+
+    # Per-request instructions go after the history so the start of the prompt stays identical
+    dynamic_notes = f"Address the user as {user_nickname} in your responses."
     if weather_info:
-        system_prompt += f" Here is current weather data to use in your response: {weather_info}"
+        dynamic_notes += f" Here is current weather data to use in your response: {weather_info}"
     if time_info:
-        system_prompt += f" {time_info}"
+        dynamic_notes += f" {time_info}"
+    if search_text:
+        dynamic_notes += f" Live search results to use in your response: {search_text}"
 
     # Determine relevant logs
-    is_summary = "summarize" in question_lower or "summary" in question_lower
-    specific_user = None
-    if "what did" in question_lower:
-        for log in channel_logs[::-1]:
-            if log["user"] != user_nickname and log["user"].lower() in question_lower:
-                specific_user = log["user"]
-                break
-
-    if is_summary:
-        relevant_logs = channel_logs[-50:]
-    elif specific_user:
-        relevant_logs = [log for log in channel_logs if log["user"] == specific_user][-10:]
-        if not relevant_logs:
-            relevant_logs = channel_logs[-25:]
-    else:
-        relevant_logs = [
-            log for log in channel_logs
-            if log["user"] == user_nickname or any(keyword in log["message"].lower() for keyword in keywords)
-        ][-5:]
+    with stage_seconds.time(stage="log_lookup"):
+        is_summary = "summary" in intents
+        specific_user = None
+        if "what_did" in intents:
+            specific_user = channel_logs.find_user(question, exclude=user_nickname, network=network)
+
+        if is_summary:
+            relevant_logs = channel_logs.recent(50, network)
+        elif specific_user:
+            relevant_logs = channel_logs.by_user(specific_user, 10, network)
+            if not relevant_logs:
+                relevant_logs = channel_logs.recent(25, network)
+        else:
+            relevant_logs = channel_logs.relevant(user_nickname, 5, network)
 
-    print("Relevant Logs:", json.dumps(relevant_logs, indent=4))
+    log_api.debug("Relevant logs: %s", LazyJSON(relevant_logs))
 
     log_messages = [
         {"role": "user" if log["user"] == user_nickname else "assistant", "content": f"{log['user']}: {log['message']}"}
         for log in relevant_logs
     ]
-
-    messages = [{"role": "system", "content": system_prompt}]
-    messages.extend(log_messages)
-    messages.extend(recent_memory)
-    messages.append({"role": "user", "content": f"{user_nickname}: {question}"})
-
-    # Determine if this is a news/search query
-    news_patterns = ["news", "latest", "trending", "headline", "what happened",
-                     "update on", "current events", "search", "find out", "look up",
-                     "who won", "score", "stock", "price of"]
-    needs_search = use_live_search and any(pattern in question_lower for pattern in news_patterns)
+    question_message = {"role": "user", "content": f"{user_nickname}: {question}"}
+    with stage_seconds.time(stage="prompt_build"):
+        messages = build_prompt(dynamic_notes, question_message, recent_memory, log_messages, max_input_tokens, summary)
 
     if needs_search:
         # Use Responses API with search tools
-        url = "https://api.x.ai/v1/responses"
+        url = f"{api_base}/responses"
         data = {
             "model": model,
             "input": messages,
@@ -277,7 +1606,7 @@ def get_grok_response(question, recent_memory, user_nickname):
         }
     else:
         # Use standard Chat Completions API
-        url = "https://api.x.ai/v1/chat/completions"
+        url = f"{api_base}/chat/completions"
         data = {
             "model": model,
             "messages": messages,
@@ -292,244 +1621,988 @@ def get_grok_response(question, recent_memory, user_nickname):
         if use_presence_penalty:
             data["presence_penalty"] = presence_penalty
 
-    print("Payload:", json.dumps(data, indent=4))
+    if use_streaming:
+        data["stream"] = True
+
+    log_api.debug("Payload: %s", LazyJSON(data))
 
     try:
-        response = requests.post(url, headers=headers, json=data, timeout=request_timeout)
-        response.raise_for_status()
+        async with api_semaphore:
+            api_calls.inc(endpoint="responses" if needs_search else "chat")
+            with stage_seconds.time(stage="api_call"):
+                response = await http_client.request("POST", url, headers=headers, json=data,
+                                                     timeout=request_timeout, stream=use_streaming)
+            response.raise_for_status()
+
+            if use_streaming:
+                source_urls = []
+                text_parts = []
+                async for event in iter_sse(response):
+                    if needs_search:
+                        if event.get("type") == "response.output_text.delta":
+                            text_parts.append(event.get("delta", ""))
+                            yield event.get("delta", "")
+                        elif event.get("type") == "response.completed":
+                            source_urls = extract_source_urls(event.get("response", {}).get("output", []))
+                    else:
+                        for choice in event.get("choices", []):
+                            content = choice.get("delta", {}).get("content")
+                            if content:
+                                yield content
+                if needs_search:
+                    result_text = clean_citations("".join(text_parts))
+                    if result_text:
+                        search_result = (result_text, source_urls[:5])
+                    if source_urls:
+                        yield " | Sources: " + " , ".join(source_urls[:5])
+                    elif not result_text:
+                        yield "Sorry, no results found."
+                elif cached_sources:
+                    yield " | Sources: " + " , ".join(cached_sources)
+                return
 
         response_data = response.json()
-        print("Response:", json.dumps(response_data, indent=4))
+        log_api.debug("Response: %s", LazyJSON(response_data))
 
         if needs_search:
             result_text = ""
-            source_urls = []
             for item in response_data.get("output", []):
                 if item.get("type") == "message":
                     for content in item.get("content", []):
                         if content.get("type") == "output_text":
                             result_text = content.get("text", "")
-                elif item.get("type") == "search_result":
-                    sr_url = item.get("url", "")
-                    if sr_url and sr_url not in source_urls:
-                        source_urls.append(sr_url)
             result_text = clean_citations(result_text)
+            source_urls = extract_source_urls(response_data.get("output", []))
+            if result_text:
+                search_result = (result_text, source_urls[:5])
             if source_urls:
                 result_text += " | Sources: " + " , ".join(source_urls[:5])
-            return result_text if result_text else "Sorry, no results found."
+            yield result_text if result_text else "Sorry, no results found."
         else:
-            return response_data['choices'][0]['message']['content']
+            answer = response_data['choices'][0]['message']['content']
+            if cached_sources:
+                answer += " | Sources: " + " , ".join(cached_sources)
+            yield answer
 
     except json.JSONDecodeError:
-        print("Error: Unable to parse JSON response.")
-        return "Sorry, I encountered an error."
+        api_errors.inc(kind="parse")
+        log_api.error("Unable to parse JSON response.")
+        yield "Sorry, I encountered an error."
     except KeyError:
-        print("Error: Expected data not found in the response.")
-        return "Sorry, something went wrong."
+        api_errors.inc(kind="parse")
+        log_api.error("Expected data not found in the response.")
+        yield "Sorry, something went wrong."
+    except CircuitOpenError as e:
+        api_errors.inc(kind="circuit_open")
+        log_api.warning("Skipping API call: %s", e)
+        yield "Sorry, the API is having trouble right now. Try again in a bit."
     except requests.exceptions.RequestException as e:
-        print(f"Unexpected error: {e}")
-        if hasattr(e, 'response') and e.response:
-            print("Response content:", e.response.text)
-        return "Sorry, an unexpected error occurred."
+        api_errors.inc(kind="timeout" if isinstance(e, requests.exceptions.Timeout) else "http")
+        log_api.error("Unexpected error: %s", e)
+        if hasattr(e, 'response') and e.response is not None:
+            log_api.error("Response content: %s", e.response.text)
+        yield "Sorry, an unexpected error occurred."
+    finally:
+        if search_key is not None:
+            if search_result:
+                search_cache.set(search_key, search_result)
+            search_flights.finish(search_key, search_flight, search_result)
+
+# Fold older conversation turns into the rolling memory summary, off the request path
+SUMMARY_INSTRUCTIONS = (
+    "You keep a running summary of an IRC user's conversation with a chat bot. Merge the previous summary "
+    "and the new turns into one short paragraph covering facts about the user, their preferences and any "
+    "open topics. Reply with the summary only."
+)
+
+async def summarize_conversation(previous, turns):
+    transcript = "\n".join(f"{entry['role']}: {entry['content']}" for entry in turns)
+    data = {
+        "model": summary_model,
+        "messages": [
+            {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+            {"role": "user", "content": f"Previous summary: {previous or '(none)'}\n\nNew turns:\n{transcript}"}
+        ],
+        "temperature": 0.2,
+        "max_tokens": summary_max_tokens
+    }
+    headers = {
+        "Authorization": f"Bearer {XAI_API_KEY}",
+        "Content-Type": "application/json"
+    }
+    async with api_semaphore:
+        api_calls.inc(endpoint="summary")
+        with stage_seconds.time(stage="summary"):
+            response = await http_client.request("POST", f"{api_base}/chat/completions", headers=headers,
+                                                 json=data, timeout=request_timeout)
+    response.raise_for_status()
+    return response.json()["choices"][0]["message"]["content"].strip()
+
+# IRC message parsing
+TAG_ESCAPES = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+
+def unescape_tag_value(value):
+    if "\\" not in value:
+        return value
+    out = []
+    i = 0
+    while i < len(value):
+        ch = value[i]
+        if ch == "\\" and i + 1 < len(value):
+            out.append(TAG_ESCAPES.get(value[i + 1], value[i + 1]))
+            i += 2
+        elif ch == "\\":
+            i += 1
+        else:
+            out.append(ch)
+            i += 1
+    return "".join(out)
+
+class IRCMessage:
+    __slots__ = ("raw", "tags", "prefix", "nick", "command", "params")
+
+    def __init__(self, raw, tags, prefix, command, params):
+        self.raw = raw
+        self.tags = tags
+        self.prefix = prefix
+        self.nick = prefix.split("!", 1)[0] if prefix else ""
+        self.command = command
+        self.params = params
+
+    @property
+    def trailing(self):
+        return self.params[-1] if self.params else ""
+
+    def __repr__(self):
+        return f"IRCMessage({self.raw!r})"
+
+def parse_message(line):
+    tags = {}
+    prefix = ""
+    rest = line
+    if rest.startswith("@"):
+        tag_str, _, rest = rest[1:].partition(" ")
+        for tag in tag_str.split(";"):
+            if tag:
+                key, _, value = tag.partition("=")
+                tags[key] = unescape_tag_value(value)
+        rest = rest.lstrip(" ")
+    if rest.startswith(":"):
+        prefix, _, rest = rest[1:].partition(" ")
+        rest = rest.lstrip(" ")
+    if " :" in rest:
+        middle, trailing = rest.split(" :", 1)
+        params = middle.split()
+        params.append(trailing)
+    elif rest.startswith(":"):
+        params = [rest[1:]]
+    else:
+        params = rest.split()
+    command = params.pop(0).upper() if params else ""
+    return IRCMessage(line, tags, prefix, command, params)
+
+# Splits the incoming byte stream into complete lines, keeping partial lines buffered
+class LineFramer:
+    # IRCv3 allows 8191 bytes of tags on top of the 512 byte message
+    MAX_LINE = 8191 + 512
+
+    def __init__(self):
+        self.buffer = b""
+
+    def feed(self, data):
+        lines = (self.buffer + data).split(b"\n")
+        self.buffer = lines.pop()
+        if len(self.buffer) > self.MAX_LINE:
+            log_irc.warning("Discarding oversized line (%d bytes)", len(self.buffer))
+            self.buffer = b""
+        messages = []
+        for raw in lines:
+            line = raw.rstrip(b"\r").decode("UTF-8", errors="ignore")
+            if line:
+                messages.append(parse_message(line))
+        return messages
+
+# Outbound flood control
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+# Commands that skip ahead of queued chat lines
+PRIORITY_COMMANDS = {"PONG", "PING", "MODE", "JOIN", "NICK", "USER", "PASS", "QUIT", "CAP", "AUTHENTICATE"}
+
+class OutboundQueue:
+    def __init__(self, rate, burst, max_depth):
+        self.bucket = TokenBucket(rate, burst)
+        self.max_depth = max_depth
+        self.priority = collections.deque()
+        self.targets = collections.OrderedDict()
+        self.depth = 0
+        # While held (between connections) only priority lines go out; chat lines wait for registration
+        self.held = False
+        self.ready = asyncio.Event()
+        self.space = asyncio.Condition()
+
+    async def put(self, line, wait=True):
+        command, _, rest = line.partition(" ")
+        if command.upper() in PRIORITY_COMMANDS:
+            self.priority.append((line, time.perf_counter()))
+        else:
+            # Backpressure: answer lines wait while the queue is full. The read loop must
+            # never wait here (it would stop answering PINGs), so its lines are dropped.
+            if not wait and self.depth >= self.max_depth:
+                lines_dropped.inc()
+                log.warning("Send queue full, dropped: %s", line)
+                return
+            async with self.space:
+                await self.space.wait_for(lambda: self.depth < self.max_depth)
+            target = rest.split(" ", 1)[0].lower()
+            self.targets.setdefault(target, collections.deque()).append((line, time.perf_counter()))
+            self.depth += 1
+        self.ready.set()
+
+    def next_line(self):
+        if self.priority:
+            return self.priority.popleft()
+        # Round-robin across targets, one line per turn
+        target, lines = next(iter(self.targets.items()))
+        line = lines.popleft()
+        if lines:
+            self.targets.move_to_end(target)
+        else:
+            del self.targets[target]
+        self.depth -= 1
+        return line
+
+    async def notify_space(self):
+        async with self.space:
+            self.space.notify_all()
+
+    def hold(self):
+        self.held = True
+        # Registration and keepalive lines belong to the connection that queued them
+        self.priority.clear()
+
+    def release(self):
+        self.held = False
+        self.ready.set()
+
+    async def run(self, writer):
+        while True:
+            while not self.priority and (self.held or not self.targets):
+                self.ready.clear()
+                await self.ready.wait()
+            await self.bucket.acquire()
+            line, queued_at = self.next_line()
+            stage_seconds.observe(time.perf_counter() - queued_at, stage="send_wait")
+            writer.write(bytes(f"{line}\r\n", "UTF-8"))
+            await writer.drain()
+            await self.notify_space()
 
 # IRC connection
-def connect_irc():
+connections = set()
+
+# Servers relay our messages as ":<nick>!<user>@<host> PRIVMSG <target> :<text>\r\n" in 512 bytes
+IRC_LINE_BYTES = 512
+MAX_HOST_BYTES = 63
+
+class IRCConnection:
+    def __init__(self, reader, writer, network):
+        self.reader = reader
+        self.writer = writer
+        self.network = network
+        self.nick = network.nickname
+        # Our prefix as other clients see it; until the server shows it, assume the longest host
+        self.source = None
+        self.caps = set()
+        self.batches = {}
+        self.ping_token = None
+        self.ping_sent = 0
+        # Seconds the local clock runs ahead of the server's, measured from the welcome's server-time
+        self.clock_offset = 0.0
+        self.timed_out = False
+        self.framer = LineFramer()
+        self.pending = collections.deque()
+        # The send queue belongs to the network, so replies queued while the link was down survive it
+        if network.outbound is None:
+            network.outbound = OutboundQueue(network.flood_rate, network.flood_burst, network.send_queue_size)
+        self.outbound = network.outbound
+        self.outbound.hold()
+        # The server's flood allowance starts fresh with each connection
+        self.outbound.bucket.tokens = self.outbound.bucket.burst
+        self.writer_task = asyncio.create_task(self.outbound.run(writer))
+        self.keepalive_task = None
+        connections.add(self)
+
+    async def send(self, line, wait=True):
+        await self.outbound.put(line, wait)
+
+    def privmsg_budget(self, target):
+        # Bytes of text that fit in one PRIVMSG to target once the server adds our prefix
+        source = self.source or f"{self.nick}!~{self.network.ident}@{'x' * MAX_HOST_BYTES}"
+        overhead = len(f":{source} PRIVMSG {target} :\r\n".encode("UTF-8"))
+        return max(IRC_LINE_BYTES - overhead, 64)
+
+    async def say(self, target, text, wait=True):
+        for piece in wrap_bytes(text, self.privmsg_budget(target)):
+            await self.send(f"PRIVMSG {target} :{piece}", wait)
+
+    async def read_message(self, timeout=None):
+        while not self.pending:
+            if self.writer_task.done():
+                raise ConnectionError(f"Writer stopped: {self.writer_task.exception()}")
+            data = await asyncio.wait_for(self.reader.read(4096), timeout)
+            if not data:
+                raise ConnectionError("Ping timeout" if self.timed_out else "Connection closed by server")
+            self.pending.extend(self.framer.feed(data))
+        return self.pending.popleft()
+
+    def start(self):
+        # Registered: let queued chat lines flow and start measuring lag
+        self.outbound.release()
+        self.keepalive_task = asyncio.create_task(self.keepalive())
+
+    async def keepalive(self):
+        # PING on a fixed interval; a missing PONG after ping_timeout means the link is dead
+        network = self.network
+        while True:
+            await asyncio.sleep(network.ping_interval)
+            token = f"grokbot-{time.monotonic_ns()}"
+            self.ping_token, self.ping_sent = token, time.monotonic()
+            await self.send(f"PING :{token}")
+            await asyncio.sleep(network.ping_timeout)
+            if self.ping_token == token:
+                log_irc.warning("No PONG from %s in %.0fs, dropping the connection", network.label, network.ping_timeout)
+                self.timed_out = True
+                self.writer.transport.abort()
+                return
+
+    def pong(self, token):
+        if token == self.ping_token:
+            self.network.lag = time.monotonic() - self.ping_sent
+            self.ping_token = None
+
+    def close(self):
+        connections.discard(self)
+        self.writer_task.cancel()
+        if self.keepalive_task:
+            self.keepalive_task.cancel()
+        self.outbound.hold()
+        self.writer.close()
+
+def make_ssl_context():
+    # Match the old ssl.wrap_socket() behaviour: encrypt, but don't verify certificates
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+# IRCv3 capabilities we use when the server offers them; sasl is added when credentials are set
+WANTED_CAPS = {"server-time", "batch", "message-tags"}
+SASL_DONE = {"903", "904", "905", "906", "907"}
+
+async def register(irc):
+    network = irc.network
+    wanted = WANTED_CAPS | ({"sasl"} if network.sasl_username else set())
+    offered = set()
+    await irc.send("CAP LS 302")
+    await irc.send(f"NICK {irc.nick}")
+    await irc.send(f"USER {network.ident} 0 * :{network.realname}")
+
     while True:
+        msg = await irc.read_message(timeout=30)
+        log_irc.debug("Received: %s", msg.raw)
+        subcommand = msg.params[1].upper() if msg.command == "CAP" and len(msg.params) > 2 else None
+
+        if subcommand == "LS":
+            offered.update(cap.split("=", 1)[0] for cap in msg.trailing.split())
+            # "CAP * LS * :..." means more lines follow
+            if len(msg.params) > 3 and msg.params[2] == "*":
+                continue
+            requested = wanted & offered
+            await irc.send(f"CAP REQ :{' '.join(sorted(requested))}" if requested else "CAP END")
+        elif subcommand == "ACK":
+            irc.caps.update(cap for cap in msg.trailing.split() if not cap.startswith("-"))
+            await irc.send("AUTHENTICATE PLAIN" if "sasl" in irc.caps else "CAP END")
+        elif subcommand == "NAK":
+            await irc.send("CAP END")
+        elif msg.command == "AUTHENTICATE" and msg.trailing == "+":
+            credentials = f"{network.sasl_username}\0{network.sasl_username}\0{network.sasl_password}"
+            await irc.send(f"AUTHENTICATE {base64.b64encode(credentials.encode('UTF-8')).decode('ascii')}")
+        elif msg.command in SASL_DONE:
+            if msg.command != "903":
+                log_irc.warning("SASL authentication failed on %s: %s", network.label, msg.trailing)
+            await irc.send("CAP END")
+        elif msg.command == "433":
+            # Nick in use, often by our own ghost from the previous connection
+            irc.nick += "_"
+            await irc.send(f"NICK {irc.nick}")
+        elif msg.command == "PING":
+            await irc.send(f"PONG :{msg.trailing}")
+        elif msg.command == "ERROR":
+            raise ConnectionError(msg.trailing)
+        elif msg.command == "001":
+            irc.nick = msg.params[0] if msg.params else irc.nick
+            welcomed_at = server_time(msg)
+            if welcomed_at:
+                irc.clock_offset = (datetime.datetime.now() - welcomed_at).total_seconds()
+            return
+
+async def connect_irc(network):
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(network.server, network.port,
+                                ssl=make_ssl_context() if network.use_ssl else None),
+        timeout=30
+    )
+    irc = IRCConnection(reader, writer, network)
+    try:
+        log_irc.info("Connected to IRC server: %s (%s)", network.server, network.label)
+        await register(irc)
+        log_irc.info("Registered on %s as %s (caps: %s). Joining channels...", network.label, irc.nick,
+                     " ".join(sorted(irc.caps)) or "none")
+        # One JOIN line for as many channels as fit
+        pending = list(network.channels)
+        while pending:
+            batch = [pending.pop(0)]
+            while pending and len(",".join(batch + pending[:1])) < 400:
+                batch.append(pending.pop(0))
+            await irc.send(f"JOIN {','.join(batch)}")
+            log_irc.info("Joining %s on %s", ", ".join(batch), network.label)
+        irc.start()
+        return irc
+    except BaseException:
+        irc.close()
+        raise
+
+# Keep references to running question tasks so they aren't garbage collected
+background_tasks = set()
+
+def spawn(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# Directives the AI can embed in an answer line
+MODE_DIRECTIVE_RE = re.compile(r'\[MODE\s+(#\S+)\s+([+-][ovaqOVAQ])\s+(.+?)\]')
+IGNORE_DIRECTIVE_RE = re.compile(r'\[IGNORE\s+(\S+)\]')
+UNIGNORE_DIRECTIVE_RE = re.compile(r'\[UNIGNORE\s+(\S+)\]')
+
+async def send_packed(irc, response_channel, messages):
+    for text in messages:
+        await irc.send(f"PRIVMSG {response_channel} :{text}")
+
+# Handle one line of an answer: run any directive it carries, otherwise pack it for sending
+async def handle_answer_line(irc, user, response_channel, line, packer):
+    stripped = line.strip()
+    mode_match = MODE_DIRECTIVE_RE.search(stripped)
+    ignore_match = None if mode_match else IGNORE_DIRECTIVE_RE.search(stripped)
+    unignore_match = None if mode_match or ignore_match else UNIGNORE_DIRECTIVE_RE.search(stripped)
+    if not (mode_match or ignore_match or unignore_match):
+        await send_packed(irc, response_channel, packer.add(stripped))
+        return
+    # Text packed so far goes out before the directive's effect
+    await send_packed(irc, response_channel, packer.flush())
+
+    # Handle IRC mode commands returned by the AI
+    if mode_match:
+        target_channel = mode_match.group(1)
+        mode = mode_match.group(2)
+        nicks = mode_match.group(3).split()
+        if user in irc.network.authorized_users and mode in allowed_modes:
+            mode_char = mode[0]
+            mode_letter = mode[1]
+            mode_string = mode_char + (mode_letter * len(nicks))
+            raw_cmd = f"MODE {target_channel} {mode_string} {' '.join(nicks)}"
+            await irc.send(raw_cmd)
+            log_irc.info("Executed IRC command from %s: %s", user, raw_cmd)
+        else:
+            await irc.send(f"PRIVMSG {response_channel} :Nice try, but no.")
+        return
+
+    # Handle ignore commands returned by the AI
+    if ignore_match:
+        target = ignore_match.group(1)
+        if user in irc.network.authorized_users:
+            ignored_users.add(irc.network.qualify(target))
+            await irc.send(f"PRIVMSG {response_channel} :{target} is now ignored.")
+        else:
+            await irc.send(f"PRIVMSG {response_channel} :Nice try, but no.")
+        return
+
+    # Handle unignore commands returned by the AI
+    target = unignore_match.group(1)
+    if user in irc.network.authorized_users:
+        ignored_users.discard(irc.network.qualify(target))
+        await irc.send(f"PRIVMSG {response_channel} :{target} is no longer ignored.")
+    else:
+        await irc.send(f"PRIVMSG {response_channel} :Nice try, but no.")
+
+# Answer a triggered question without blocking the read loop, sending lines as they stream in
+async def answer_question(irc, user, channel, question, intents):
+    try:
+        questions_total.inc()
+        start = time.perf_counter()
+        network = irc.network
+        memory_key = network.qualify(user)
+        recent_memory = memory_store.recent(memory_key)
+        summary = memory_store.summary(memory_key)
+        response_channel = channel if irc_lower(channel) != irc_lower(irc.nick) else user
+        assembler = LineAssembler()
+        packer = ReplyPacker(irc.privmsg_budget(response_channel))
+        answer_lines = []
+        first_line_sent = False
+
+        async def emit(lines):
+            # first_line measures until the first answer PRIVMSG is queued, not assembled
+            nonlocal first_line_sent
+            for line in lines:
+                answer_lines.append(line)
+                await handle_answer_line(irc, user, response_channel, line, packer)
+                if packer.started and not first_line_sent:
+                    first_line_sent = True
+                    stage_seconds.observe(time.perf_counter() - start, stage="first_line")
+
+        async for text in get_grok_response(question, recent_memory, user, intents, network.name, summary):
+            await emit(assembler.feed(text))
+        await emit(assembler.flush())
+        await send_packed(irc, response_channel, packer.flush())
+        stage_seconds.observe(time.perf_counter() - start, stage="total")
+
+        memory_store.add(memory_key, "user", question)
+        memory_store.add(memory_key, "assistant", "\n".join(answer_lines))
+    except Exception as e:
+        log.exception("Error answering %s in %s on %s: %s", user, channel, irc.network.label, e)
+
+# Question scheduling: bounded per-user and per-channel queues, weighted round-robin
+# across channels, one question in flight per user, and a deadline on waiting
+class Question:
+    def __init__(self, irc, user, channel, text, intents):
+        self.irc = irc
+        self.user = user
+        self.channel = channel
+        self.text = text
+        self.intents = intents
+        self.reply_to = channel if irc_lower(channel) != irc_lower(irc.nick) else user
+        self.user_key = (irc.network.name, irc_lower(user))
+        self.channel_key = (irc.network.name, irc_lower(self.reply_to))
+        self.queued_at = time.monotonic()
+
+class QuestionScheduler:
+    def __init__(self, max_in_flight, per_user, per_channel, deadline, weights=None):
+        self.max_in_flight = max_in_flight
+        self.per_user = per_user
+        self.per_channel = per_channel
+        self.deadline = deadline
+        self.weights = weights or {}
+        self.priority = collections.deque()
+        self.channels = collections.OrderedDict()
+        self.credit = {}
+        self.user_depth = collections.Counter()
+        self.channel_depth = collections.Counter()
+        self.busy_users = set()
+        self.in_flight = 0
+        self.ready = asyncio.Event()
+
+    def __len__(self):
+        return sum(self.user_depth.values())
+
+    def submit(self, question, priority=False):
+        # Returns the reason the question was refused, or None once it is queued
+        if self.user_depth[question.user_key] >= self.per_user:
+            return "user_limit"
+        if priority:
+            self.priority.append(question)
+        else:
+            if self.channel_depth[question.channel_key] >= self.per_channel:
+                return "channel_limit"
+            users = self.channels.setdefault(question.channel_key, collections.OrderedDict())
+            users.setdefault(question.user_key, collections.deque()).append(question)
+            self.channel_depth[question.channel_key] += 1
+        self.user_depth[question.user_key] += 1
+        self.ready.set()
+        return None
+
+    def discard(self, question):
+        self.user_depth[question.user_key] -= 1
+        if not self.user_depth[question.user_key]:
+            del self.user_depth[question.user_key]
+
+    def next_question(self):
+        for question in self.priority:
+            if question.user_key not in self.busy_users:
+                self.priority.remove(question)
+                self.discard(question)
+                return question
+
+        # Each channel gets `weight` turns per round, one question per turn
+        for _ in range(len(self.channels)):
+            channel_key, users = next(iter(self.channels.items()))
+            if self.credit.get(channel_key, 0) < 1:
+                self.credit[channel_key] = self.credit.get(channel_key, 0) + self.weights.get(channel_key, 1)
+            for user_key, questions in users.items():
+                if user_key not in self.busy_users:
+                    question = questions.popleft()
+                    if questions:
+                        users.move_to_end(user_key)
+                    else:
+                        del users[user_key]
+                    self.channel_depth[channel_key] -= 1
+                    self.credit[channel_key] -= 1
+                    if not users:
+                        del self.channels[channel_key]
+                        del self.channel_depth[channel_key]
+                        self.credit.pop(channel_key, None)
+                    elif self.credit[channel_key] < 1:
+                        self.channels.move_to_end(channel_key)
+                    self.discard(question)
+                    return question
+            self.channels.move_to_end(channel_key)
+        return None
+
+    def expire(self):
+        # Remove and return questions that have waited past the deadline
+        now = time.monotonic()
+        def stale(question):
+            return now - question.queued_at > self.deadline
+        expired = [q for q in self.priority if stale(q)]
+        self.priority = collections.deque(q for q in self.priority if not stale(q))
+        for channel_key, users in list(self.channels.items()):
+            for user_key, questions in list(users.items()):
+                for question in [q for q in questions if stale(q)]:
+                    questions.remove(question)
+                    self.channel_depth[channel_key] -= 1
+                    expired.append(question)
+                if not questions:
+                    del users[user_key]
+            if not users:
+                del self.channels[channel_key]
+                del self.channel_depth[channel_key]
+                self.credit.pop(channel_key, None)
+        for question in expired:
+            self.discard(question)
+        return expired
+
+    async def drop(self, question):
+        # Replies go to the network's send queue, so this still arrives after a reconnect
+        questions_dropped.inc(reason="stale")
+        log.info("Dropped question from %s in %s after %.0fs in queue", question.user, question.channel,
+                 time.monotonic() - question.queued_at)
+        await question.irc.send(f"PRIVMSG {question.reply_to} :{question.user}, sorry, I couldn't get to that in time. Please ask again.")
+
+    async def work(self, question, handler):
         try:
-            irc = socket.create_connection((server, port), timeout=30)
-            if use_ssl:
-                irc = ssl.wrap_socket(irc)
-            irc.send(bytes(f"USER {ident} 0 * :{realname}\n", "UTF-8"))
-            irc.send(bytes(f"NICK {nickname}\n", "UTF-8"))
-            print(f"Connected to IRC server: {server}")
-
-            empty_count = 0
-            while True:
-                data = irc.recv(4096).decode("UTF-8", errors="ignore")
-                print(f"Received: {data}")
-
-                if not data.strip():
-                    empty_count += 1
-                    if empty_count >= 5:
-                        print("Connection died during handshake. Retrying...")
-                        irc.close()
-                        break
-                    continue
-                else:
-                    empty_count = 0
-
-                if "001" in data:
-                    print("Successfully connected. Joining channels...")
-                    for channel in channels:
-                        irc.send(bytes(f"JOIN {channel}\n", "UTF-8"))
-                        print(f"Joining channel: {channel}")
-                    irc.settimeout(None)
-                    return irc
-                elif data.startswith("PING"):
-                    irc.send(bytes(f"PONG {data.split()[1]}\n", "UTF-8"))
-        except Exception as e:
-            print(f"Connection failed: {e}")
+            stage_seconds.observe(time.monotonic() - question.queued_at, stage="queue_wait")
+            await handler(question.irc, question.user, question.channel, question.text, question.intents)
+        finally:
+            self.in_flight -= 1
+            self.busy_users.discard(question.user_key)
+            self.ready.set()
+
+    async def run(self, handler):
+        while True:
+            self.ready.clear()
+            for question in self.expire():
+                spawn(self.drop(question))
+            while self.in_flight < self.max_in_flight:
+                question = self.next_question()
+                if question is None:
+                    break
+                self.in_flight += 1
+                self.busy_users.add(question.user_key)
+                spawn(self.work(question, handler))
             try:
-                irc.close()
-            except:
+                await asyncio.wait_for(self.ready.wait(), max(1, self.deadline / 4))
+            except asyncio.TimeoutError:
                 pass
-            time.sleep(10)
+
+# Weights are keyed like the scheduler's channel keys; on a multi-network setup a
+# channel is written network/#channel, as with the ignore and opt-out lists
+def parse_channel_weights(entries):
+    weights = {}
+    for entry in entries:
+        channel, _, weight = entry.rpartition(":")
+        network, _, name = channel.strip().partition("/")
+        if network not in network_names:
+            network, name = "", channel.strip()
+        try:
+            weights[(network, irc_lower(name))] = max(1.0, float(weight))
+        except ValueError:
+            log.warning("Ignoring channel weight %r; expected [network/]#channel:weight", entry)
+    return weights
+
+question_scheduler = QuestionScheduler(max_in_flight, queue_per_user, queue_per_channel, question_deadline,
+                                       parse_channel_weights(channel_weights))
+
+# Gauges over the bot's queues, stores and caches
+def outbound_depth():
+    return sum(n.outbound.depth + len(n.outbound.priority) for n in networks if n.outbound is not None)
+
+def http_stat(name):
+    return lambda: {endpoint: getattr(stats, name) for endpoint, stats in http_client.stats.items()}
+
+metrics.extend([
+    Gauge("grokbot_outbound_queue_depth", "Lines waiting to be sent to IRC", outbound_depth),
+    Gauge("grokbot_channel_log_entries", "Channel log lines held in memory", lambda: len(channel_logs)),
+    Gauge("grokbot_memory_users_loaded", "Users whose conversation memory is loaded", lambda: len(memory_store.users)),
+    Gauge("grokbot_cache_entries", "Entries in each cache", lambda: {
+        "geocode": len(geocode_cache), "forecast": len(forecast_cache), "search": len(search_cache)
+    }, label="cache"),
+    Gauge("grokbot_connected", "1 for each network with a live connection", lambda: {
+        network.label: int(any(irc.network is network for irc in connections)) for network in networks
+    }, label="network"),
+    Gauge("grokbot_irc_lag_seconds", "Round trip of the last keepalive PING, by network", lambda: {
+        network.label: network.lag for network in networks if network.lag is not None
+    }, label="network"),
+    Gauge("grokbot_questions_queued", "Questions waiting for the scheduler", lambda: len(question_scheduler)),
+    Gauge("grokbot_questions_in_flight", "Questions being answered", lambda: question_scheduler.in_flight),
+    Gauge("grokbot_tasks_running", "Background and question tasks running", lambda: len(background_tasks)),
+    Gauge("grokbot_http_requests", "HTTP requests made, by endpoint", http_stat("requests"), label="endpoint"),
+    Gauge("grokbot_http_errors", "HTTP requests that failed, by endpoint", http_stat("errors"), label="endpoint"),
+    Gauge("grokbot_http_timeouts", "HTTP requests that timed out, by endpoint", http_stat("timeouts"), label="endpoint"),
+    Gauge("grokbot_http_retries", "HTTP retries, by endpoint", http_stat("retries"), label="endpoint"),
+    Gauge("grokbot_circuit_open", "1 while a host's circuit breaker is open", lambda: {
+        host: int(breaker.state == "open") for host, breaker in http_client.breakers.items()
+    }, label="host"),
+])
+
+def stats_summary():
+    def seconds(q, stage):
+        value = stage_seconds.quantile(q, stage=stage)
+        return "-" if value is None else f"{value:g}s"
+    return (
+        f"msgs/sec (1m): {message_rate.rate():.2f} | questions: {questions_total.total()} | "
+        f"api chat/responses: {api_calls.total(endpoint='chat')}/{api_calls.total(endpoint='responses')} | "
+        f"api errors: {api_errors.total()} | first line p50/p95: {seconds(0.5, 'first_line')}/{seconds(0.95, 'first_line')} | "
+        f"total p50/p95: {seconds(0.5, 'total')}/{seconds(0.95, 'total')} | queue: {outbound_depth()} | "
+        f"questions queued/dropped: {len(question_scheduler)}/{questions_dropped.total()} | "
+        f"logs: {len(channel_logs)} | memory users: {len(memory_store.users)} | "
+        f"lag: {', '.join(f'{n.label} {n.lag * 1000:.0f}ms' for n in networks if n.lag is not None) or '-'}"
+    )
+
+# IRC command handlers
+session_duration = 2
+version_response = "IRC Grok Bot by m0n https://github.com/timmo-x/irc_grokbot"
+
+async def handle_ping(irc, msg):
+    await irc.send(f"PONG :{msg.trailing}")
+
+async def handle_pong(irc, msg):
+    irc.pong(msg.trailing)
+
+# Batches whose messages are history being replayed, not live chat
+HISTORY_BATCHES = {"chathistory", "znc.in/playback"}
+
+async def handle_batch(irc, msg):
+    if not msg.params:
+        return
+    reference = msg.params[0]
+    if reference.startswith("+"):
+        irc.batches[reference[1:]] = msg.params[1] if len(msg.params) > 1 else ""
+    elif reference.startswith("-"):
+        irc.batches.pop(reference[1:], None)
+
+def server_time(msg):
+    # Local time the server says a message was sent (IRCv3 server-time), if it said
+    value = msg.tags.get("time")
+    if not value:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value.replace("Z", "+00:00")).astimezone().replace(tzinfo=None)
+    except ValueError:
+        return None
+
+async def handle_invite(irc, msg):
+    inviting_user = msg.nick
+    invited_channel = msg.trailing
+    if inviting_user in irc.network.authorized_users:
+        # Remember the channel so it is rejoined after a reconnect
+        if irc_lower(invited_channel) not in {irc_lower(c) for c in irc.network.channels}:
+            irc.network.channels.append(invited_channel)
+        await irc.send(f"JOIN {invited_channel}")
+        log_irc.info("Accepted invite from %s to %s", inviting_user, invited_channel)
+    else:
+        log_irc.info("Ignored invite from unauthorized user %s to %s", inviting_user, invited_channel)
+
+async def handle_join(irc, msg):
+    # The server echoes our own JOIN with the prefix other clients see for us
+    if irc_lower(msg.nick) == irc_lower(irc.nick):
+        irc.source = msg.prefix
+
+async def handle_nick(irc, msg):
+    if irc_lower(msg.nick) == irc_lower(irc.nick):
+        irc.nick = msg.trailing
+        if irc.source:
+            irc.source = f"{irc.nick}!{irc.source.split('!', 1)[1]}"
+
+async def handle_displayed_host(irc, msg):
+    # RPL_HOSTHIDDEN: a cloak or vhost replaced our host
+    if irc.source and len(msg.params) > 1:
+        irc.source = f"{irc.source.split('@', 1)[0]}@{msg.params[1]}"
+
+async def handle_privmsg(irc, msg):
+    if len(msg.params) < 2:
+        return
+    user = msg.nick
+    channel = msg.params[0]
+    message = msg.trailing.strip()
+
+    # Skip ignored users entirely
+    if irc.network.qualify(user) in ignored_users:
+        return
+
+    sent_at = server_time(msg)
+    add_to_channel_logs(channel, user, message, irc.network, sent_at)
+
+    # Replayed history (a bouncer or chathistory batch, or anything older than the
+    # scheduler deadline by the server's clock) goes into the logs but is never answered
+    if irc.batches.get(msg.tags.get("batch")) in HISTORY_BATCHES:
+        return
+    if sent_at and (datetime.datetime.now() - sent_at).total_seconds() - irc.clock_offset > question_deadline:
+        return
+
+    if message == "\001VERSION\001":
+        await irc.send(f"NOTICE {user} :\001VERSION {version_response}\001", wait=False)
+        log_irc.info("Sent CTCP VERSION response to %s: %s", user, version_response)
+        return
+    elif message == "!info":
+        await irc.send(f"PRIVMSG {channel} :This bot logs channel messages to provide context for responses. Use !optout to exclude your messages.", wait=False)
+        return
+    elif message == "!optout":
+        if irc.network.qualify(user) not in optout_users:
+            optout_users.add(irc.network.qualify(user))
+            await irc.send(f"PRIVMSG {channel} :{user}, you have opted out of message logging.", wait=False)
+        return
+    elif message.startswith("!search "):
+        query = message[8:]
+        relevant_logs = channel_logs.search(query, network=irc.network.name)
+        if relevant_logs:
+            response = f"{user}, found these: " + "; ".join(f"{log['user']}: {log['message']}" for log in relevant_logs)
+        else:
+            response = f"{user}, nothing found for '{query}'."
+        await irc.say(channel, response, wait=False)
+        return
+    elif message == "!stats" and user in irc.network.authorized_users:
+        # Admin commands usually come in private, where channel is our own nick
+        reply_to = channel if irc_lower(channel) != irc_lower(irc.nick) else user
+        await irc.say(reply_to, stats_summary(), wait=False)
+        return
+    elif message == "!reload" and user in irc.network.authorized_users:
+        reload_files(force=True)
+        reply_to = channel if irc_lower(channel) != irc_lower(irc.nick) else user
+        await irc.send(f"PRIVMSG {reply_to} :{user}, reloaded ignore, opt-out and context files.", wait=False)
+        return
+
+    chat_sessions = irc.network.chat_sessions
+    current_time = time.time()
+    active_session = user in chat_sessions and (current_time - chat_sessions[user] < session_duration)
+
+    intents = intent_matcher.match(message)
+    if "trigger" in intents:
+        chat_sessions[user] = current_time
+        active_session = True
+
+    if active_session:
+        chat_sessions[user] = current_time
+        question = Question(irc, user, channel, message, intents)
+        refused = question_scheduler.submit(question, priority=user in irc.network.authorized_users)
+        if refused:
+            questions_dropped.inc(reason=refused)
+            await irc.send(f"PRIVMSG {question.reply_to} :{user}, I'm still working through earlier questions. Please wait a moment.", wait=False)
+
+    irc.network.chat_sessions = {user: timestamp for user, timestamp in chat_sessions.items() if current_time - timestamp < session_duration}
+
+COMMAND_HANDLERS = {
+    "PING": handle_ping,
+    "PONG": handle_pong,
+    "BATCH": handle_batch,
+    "INVITE": handle_invite,
+    "JOIN": handle_join,
+    "NICK": handle_nick,
+    "396": handle_displayed_host,
+    "PRIVMSG": handle_privmsg,
+}
+
+async def dispatch(irc, msg):
+    messages_received.inc(command=msg.command)
+    message_rate.mark()
+    handler = COMMAND_HANDLERS.get(msg.command)
+    if handler:
+        await handler(irc, msg)
 
 # Main loop
-def main():
+async def main():
+    log_listener = setup_logging()
+    channel_logs.load()
+    memory_store.load()
+    reload_files(force=True)
+    if geocode_cache_file:
+        geocode_cache.load(geocode_cache_file)
+        spawn(save_geocode_cache_loop())
+    spawn(watch_files())
+    if metrics_port:
+        await asyncio.start_server(handle_metrics_request, metrics_host, metrics_port)
+        log.info("Serving metrics on http://%s:%d/metrics", metrics_host, metrics_port)
+    spawn(channel_logs.flush_loop())
+    spawn(memory_store.compact_loop())
+    if summary_threshold:
+        spawn(memory_store.summarize_loop(summarize_conversation))
+    spawn(question_scheduler.run(answer_question))
+    try:
+        await asyncio.gather(*(run_bot(network) for network in networks))
+    finally:
+        channel_logs.flush()
+        if geocode_cache_file and geocode_cache.dirty:
+            geocode_cache.save(geocode_cache_file)
+        log_listener.stop()
+
+# A connection that stayed up this long resets the reconnect backoff
+STABLE_CONNECTION_SECONDS = 60
+
+# Past this many doublings the delay is pinned at reconnect_max_delay anyway
+MAX_BACKOFF_EXPONENT = 16
+
+def reconnect_delay(network, attempt):
+    # Full jitter, so the first retry is almost immediate and later ones spread out
+    exponent = min(attempt, MAX_BACKOFF_EXPONENT)
+    return random.uniform(0, min(network.reconnect_max_delay, network.reconnect_delay * 2 ** exponent))
+
+async def run_bot(network):
+    attempt = 0
     while True:
+        irc = None
+        connected_at = None
         try:
-            irc = connect_irc()
-            memory = load_memory()
-            chat_sessions = {}
-            session_duration = 2
-            version_response = "IRC Grok Bot by m0n https://github.com/timmo-x/irc_grokbot"
-            empty_count = 0
-
+            irc = await connect_irc(network)
+            connected_at = time.monotonic()
             while True:
-                data = irc.recv(4096).decode("UTF-8", errors="ignore")
-
-                # Detect dead connection (repeated empty receives)
-                if not data.strip():
-                    empty_count += 1
-                    if empty_count >= 5:
-                        print("Connection lost (repeated empty receives). Reconnecting...")
-                        irc.close()
-                        break
-                    continue
-                else:
-                    empty_count = 0
-
-                print(f"Received: {data}")
-
-                if data.startswith("PING"):
-                    irc.send(bytes(f"PONG {data.split()[1]}\n", "UTF-8"))
-
-                elif " INVITE " in data:
-                    inviting_user = data.split('!')[0][1:]
-                    invited_channel = data.split(':')[-1].strip()
-                    if inviting_user in authorized_users:
-                        irc.send(bytes(f"JOIN {invited_channel}\n", "UTF-8"))
-                        print(f"Accepted invite from {inviting_user} to {invited_channel}")
-                    else:
-                        print(f"Ignored invite from unauthorized user {inviting_user} to {invited_channel}")
-
-                elif "PRIVMSG" in data:
-                    user = data.split('!')[0][1:]
-                    message = ':'.join(data.split(':')[2:]).strip()
-                    channel = data.split(' PRIVMSG ')[-1].split(' :')[0]
-
-                    # Skip ignored users entirely
-                    if user in load_ignored_users():
-                        continue
-
-                    add_to_channel_logs(channel, user, message)
-
-                    if message == "\001VERSION\001":
-                        irc.send(bytes(f"NOTICE {user} :\001VERSION {version_response}\001\n", "UTF-8"))
-                        print(f"Sent CTCP VERSION response to {user}: {version_response}")
-                        continue
-                    elif message == "!info":
-                        irc.send(bytes(f"PRIVMSG {channel} :This bot logs channel messages to provide context for responses. Use !optout to exclude your messages.\n", "UTF-8"))
-                        continue
-                    elif message == "!optout":
-                        optout_users = load_optout_users()
-                        if user not in optout_users:
-                            optout_users.append(user)
-                            save_optout_users(optout_users)
-                            irc.send(bytes(f"PRIVMSG {channel} :{user}, you have opted out of message logging.\n", "UTF-8"))
-                        continue
-                    elif message.startswith("!search "):
-                        query = message[8:].lower()
-                        relevant_logs = [log for log in load_channel_logs() if query in log["message"].lower()][-3:]
-                        if relevant_logs:
-                            response = f"{user}, found these: " + "; ".join(f"{log['user']}: {log['message']}" for log in relevant_logs)
-                        else:
-                            response = f"{user}, nothing found for '{query}'."
-                        irc.send(bytes(f"PRIVMSG {channel} :{response}\n", "UTF-8"))
-                        continue
-
-                    current_time = time.time()
-                    active_session = user in chat_sessions and (current_time - chat_sessions[user] < session_duration)
-
-                    if any(keyword in message.lower() for keyword in keywords):
-                        chat_sessions[user] = current_time
-                        active_session = True
-
-                    if active_session:
-                        chat_sessions[user] = current_time
-                        question = message.strip()
-                        recent_memory = get_recent_memory(memory, user)
-                        answer = get_grok_response(question, recent_memory, user)
-                        answer = clean_citations(answer)
-                        add_to_memory(memory, user, "user", question)
-                        add_to_memory(memory, user, "assistant", answer)
-
-                        response_channel = channel if channel != nickname else user
-                        answer_lines = answer.split('\n')
-                        for line in answer_lines:
-                            stripped = line.strip()
-
-                            # Handle IRC mode commands returned by the AI
-                            mode_match = re.search(r'\[MODE\s+(#\S+)\s+([+-][ovaqOVAQ])\s+(.+?)\]', stripped)
-                            if mode_match:
-                                target_channel = mode_match.group(1)
-                                mode = mode_match.group(2)
-                                nicks = mode_match.group(3).split()
-                                if user in authorized_users and mode in allowed_modes:
-                                    mode_char = mode[0]
-                                    mode_letter = mode[1]
-                                    mode_string = mode_char + (mode_letter * len(nicks))
-                                    raw_cmd = f"MODE {target_channel} {mode_string} {' '.join(nicks)}"
-                                    irc.send(bytes(f"{raw_cmd}\n", "UTF-8"))
-                                    print(f"Executed IRC command from {user}: {raw_cmd}")
-                                else:
-                                    irc.send(bytes(f"PRIVMSG {response_channel} :Nice try, but no.\n", "UTF-8"))
-                                continue
-
-                            # Handle ignore commands returned by the AI
-                            ignore_match = re.search(r'\[IGNORE\s+(\S+)\]', stripped)
-                            if ignore_match:
-                                target = ignore_match.group(1)
-                                if user in authorized_users:
-                                    ignored = load_ignored_users()
-                                    if target not in ignored:
-                                        ignored.append(target)
-                                        save_ignored_users(ignored)
-                                    irc.send(bytes(f"PRIVMSG {response_channel} :{target} is now ignored.\n", "UTF-8"))
-                                else:
-                                    irc.send(bytes(f"PRIVMSG {response_channel} :Nice try, but no.\n", "UTF-8"))
-                                continue
-
-                            # Handle unignore commands returned by the AI
-                            unignore_match = re.search(r'\[UNIGNORE\s+(\S+)\]', stripped)
-                            if unignore_match:
-                                target = unignore_match.group(1)
-                                if user in authorized_users:
-                                    ignored = load_ignored_users()
-                                    if target in ignored:
-                                        ignored.remove(target)
-                                        save_ignored_users(ignored)
-                                    irc.send(bytes(f"PRIVMSG {response_channel} :{target} is no longer ignored.\n", "UTF-8"))
-                                else:
-                                    irc.send(bytes(f"PRIVMSG {response_channel} :Nice try, but no.\n", "UTF-8"))
-                                continue
-
-                            line_parts = [line[i:i+400] for i in range(0, len(line), 400)]
-                            for part in line_parts:
-                                delay = random.uniform(0, 1)
-                                time.sleep(delay)
-                                irc.send(bytes(f"PRIVMSG {response_channel} :{part}\n", "UTF-8"))
-
-                    chat_sessions = {user: timestamp for user, timestamp in chat_sessions.items() if current_time - timestamp < session_duration}
+                msg = await irc.read_message()
+                log_irc.debug("Received: %s", msg.raw)
+                await dispatch(irc, msg)
 
         except Exception as e:
-            print(f"Error in main loop: {e}. Reconnecting in 10 seconds...")
-            try:
+            log.error("Error in main loop for %s: %s", network.label, e)
+            if irc:
                 irc.close()
-            except:
-                pass
-            time.sleep(10)
+        if connected_at is not None and time.monotonic() - connected_at > STABLE_CONNECTION_SECONDS:
+            attempt = 0
+        delay = reconnect_delay(network, attempt)
+        attempt += 1
+        reconnects.inc(network=network.label)
+        log.info("Reconnecting to %s in %.1f seconds (attempt %d)", network.label, delay, attempt)
+        await asyncio.sleep(delay)
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())